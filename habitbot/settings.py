@@ -73,10 +73,12 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'habits.middleware.QueryStatsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'habits.middleware.UserTimezoneMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
@@ -147,6 +149,10 @@ LOGGING = {
             'level': 'ERROR',
             'filters': ['require_debug_false'],
             'class': 'django.utils.log.AdminEmailHandler'
+        },
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler'
         }
     },
     'loggers': {
@@ -155,9 +161,44 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        'habits.querystats': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     }
 }
 
+# Maximum number of compiled (rrule, timezone) pairs kept in memory per process.
+HABITS_RRULE_CACHE_SIZE = 1024
+
+# Maximum number of parsed goal recurrences ("every weekday", ...) kept in
+# memory per process.
+HABITS_PARSE_CACHE_SIZE = 256
+
+# geninstances only tops up goals with fewer than this many days of
+# scheduled instances already generated ahead of now.
+HABITS_MATERIALIZE_HORIZON_DAYS = 2
+
+# When True, occurrences in the future are computed from each goal's rrule
+# when read and only written to the database once they are acted on.
+HABITS_VIRTUAL_INSTANCES = False
+
+# Seconds a user's dashboard (todo, completed and skipped instances) is
+# cached for; 0 turns the cache off. Entries are dropped whenever the user's
+# goals or instances change, through a version number kept in the default
+# cache, so that cache must be shared by all processes (e.g. memcached)
+# before this is turned on. Users' timezones are only cached while it is on.
+HABITS_DASHBOARD_CACHE_TIMEOUT = 0
+
+# Adds X-Query-Count, X-Query-Time, X-Slowest-Query and X-Response-Time
+# headers to every response. Meant for development.
+HABITS_QUERY_STATS_HEADERS = False
+
+# Fraction of requests whose query count, SQL time, slowest statement and
+# wall time are logged as JSON to the habits.querystats logger.
+HABITS_QUERY_STATS_SAMPLE_RATE = 0.01
+
 from settings_secret import *
 
 if os.environ.get('DEVELOPMENT', None):
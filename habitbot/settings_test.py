@@ -0,0 +1,13 @@
+# Settings for running the test suite against sqlite:
+#
+#     python manage.py test habits --settings=habitbot.settings_test
+
+import os
+
+from habitbot.settings import *
+
+# sqlite test databases default to in-memory, which a single connection
+# owns; a file lets the concurrency tests open one connection per thread.
+for db in DATABASES.values():
+    if db['ENGINE'] == 'django.db.backends.sqlite3':
+        db.setdefault('TEST_NAME', os.path.join(os.path.dirname(__file__), 'test-habitbot.db'))
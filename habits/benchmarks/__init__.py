@@ -0,0 +1,23 @@
+"""
+Tools for measuring the habits app against large synthetic datasets: a
+loader for fake users, goals and instance history, and timing helpers.
+Nothing here is imported by the app itself.
+"""
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+
+    if not ordered:
+        return None
+
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(samples):
+    """
+    Median, 95th percentile and max of a list of timings in seconds, as
+    milliseconds.
+    """
+    return {'median_ms': percentile(samples, 0.5) * 1000,
+            'p95_ms': percentile(samples, 0.95) * 1000,
+            'max_ms': max(samples) * 1000,
+            'runs': len(samples)}
@@ -0,0 +1,343 @@
+"""
+Synthetic users, goals and instance history, written with bulk inserts.
+
+Goals are copies of a few parsed templates, so the occurrences of each
+(template, timezone) pair are expanded once and shared by every goal using
+it; instance rows are then written with executemany without building model
+instances, which is what makes datasets of tens of millions of rows
+practical.
+"""
+
+from contextlib import contextmanager
+import datetime
+import random
+import re
+
+import pytz
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from habits import usercontext
+from habits.models import Goal, UserProfile
+
+# the same kinds of goals the tests use, plus a few more shapes of rule
+GOAL_TEXTS = [
+    "Go for a walk every day",
+    "Pet a kitty every weekday",
+    "Pet a kitty every other day",
+    "Pet a kitty every 3 days",
+    "Do a timed mile run every week",
+    "Go to the gym every monday, wednesday and friday",
+    "Run every tuesday and saturday",
+    "Call mom every sunday",
+    "Water the plants every 2 weeks",
+    "Pay rent every month",
+    "2 hours of studying every day",
+]
+
+INCREMENTAL_GOAL_TEXTS = [
+    "Do pushups 20 times every day",
+    "Go to the gym 3 times every week",
+    "Drink water 8x every day",
+    "Practice piano 2 times every weekday",
+]
+
+INSERT_BATCH = 5000
+
+# goals per multi-row INSERT, which sqlite limits to 999 parameters
+GOAL_INSERT_BATCH = 50
+
+# users created, and whose goals and instances are inserted, per round
+USERS_PER_ROUND = 500
+
+OPEN, COMPLETED, SKIPPED = range(3)
+
+INSERT_INSTANCES_SQL = """
+    INSERT INTO habits_scheduledinstance (goal_id, date, due_date, completed, current_progress, skipped)
+    VALUES (%s, %s, %s, %s, %s, %s)
+"""
+
+@contextmanager
+def test_database(verbosity=0):
+    """
+    Runs the enclosed block against a freshly created test database, built
+    by running the migrations so it has every index production has.
+    """
+    if 'south' in settings.INSTALLED_APPS:
+        from south.management.commands import patch_for_test_db_setup
+
+        with override_settings(SOUTH_TESTS_MIGRATE=True):
+            patch_for_test_db_setup()
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity, autoclobber=True)
+
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity)
+
+def has_midnight(tz, start, end):
+    """
+    Whether every day between start and end starts at midnight in tz. Rules
+    can't be expanded in zones whose clocks jump over midnight.
+    """
+    day = start.date()
+
+    while day <= end.date():
+        try:
+            tz.localize(datetime.datetime(day.year, day.month, day.day), is_dst=None)
+        except pytz.NonExistentTimeError:
+            return False
+
+        day += datetime.timedelta(days=1)
+
+    return True
+
+def pick_timezones(rng, count, start, end):
+    names = sorted(pytz.common_timezones)
+    rng.shuffle(names)
+
+    picked = []
+
+    for name in names:
+        if len(picked) == count:
+            break
+
+        if has_midnight(pytz.timezone(name), start, end):
+            picked.append(name)
+
+    return picked
+
+def parse_templates(user, texts):
+    templates = []
+
+    for text in texts:
+        goal = Goal(user=user)
+        goal.parse(text)
+
+        # the start is set per goal
+        goal.rrule = re.sub(r'^DTSTART:\d{8}\n', '', goal.rrule)
+
+        templates.append(goal)
+
+    return templates
+
+def streaks(states, dates, today):
+    """
+    Same as Goal.streaks_from_history for a goal whose instances have the
+    given states and dates, oldest first.
+    """
+    run, longest = 0, 0
+
+    for state, date in zip(states, dates):
+        if date > today:
+            break
+
+        if state == COMPLETED:
+            run += 1
+            longest = max(longest, run)
+        elif state == OPEN and date < today:
+            run = 0
+
+    return run, longest
+
+class Generator(object):
+    def __init__(self, seed, days, completion_rate, skip_rate, incremental_ratio, timezones, anchor=None):
+        self.rng = random.Random(seed)
+        self.now = anchor or timezone.now()
+        self.start = (self.now - datetime.timedelta(days=days)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+        self.completion_rate = completion_rate
+        self.skip_rate = skip_rate
+        self.incremental_ratio = incremental_ratio
+
+        self.timezones = pick_timezones(self.rng, timezones, self.start, self.now + datetime.timedelta(days=7))
+        self.templates = None
+        self.incremental_templates = None
+
+        # (template index, incremental, timezone) -> expanded occurrences
+        self.tables = {}
+
+    def occurrence_table(self, key, template, user):
+        """
+        Every occurrence of template between the start of the history and
+        now in the timezone of user, as (local start day, date, due date)
+        with the dates converted for the database once.
+        """
+        if key in self.tables:
+            return self.tables[key]
+
+        tz_name = key[2]
+        to_db = connection.ops.value_to_db_datetime
+
+        goal = Goal(user_id=user.id, rrule="DTSTART:%s\n%s" % (self.start.strftime("%Y%m%d"), template.rrule))
+
+        usercontext.activate(user.id, tz_name)
+
+        try:
+            tz = pytz.timezone(tz_name)
+            table = {'today': usercontext.local_midnight_utc(tz, self.now), 'rows': []}
+
+            for date, due_date in goal.occurrences(self.start):
+                if date > self.now:
+                    break
+
+                table['rows'].append((date.astimezone(tz).strftime("%Y%m%d"), date, to_db(date), due_date,
+                                      to_db(due_date) if due_date is not None else None))
+        finally:
+            usercontext.deactivate()
+
+        self.tables[key] = table
+
+        return table
+
+    def plan_goal(self, user, tz_name):
+        """
+        A new, unsaved goal for user and the states of its instances.
+        """
+        if self.rng.random() < self.incremental_ratio:
+            index = self.rng.randrange(len(self.incremental_templates))
+            key, template = (index, True, tz_name), self.incremental_templates[index]
+        else:
+            index = self.rng.randrange(len(self.templates))
+            key, template = (index, False, tz_name), self.templates[index]
+
+        table = self.occurrence_table(key, template, user)
+        rows = table['rows']
+
+        # goals were created at some point in the first half of the history
+        first = self.rng.randrange(max(1, len(rows) // 2))
+        rows = rows[first:]
+
+        goal = Goal(user=user,
+                    creation_text=template.creation_text,
+                    description=template.description,
+                    freq=template.freq,
+                    byday=template.byday,
+                    incremental=template.incremental,
+                    goal_amount=template.goal_amount)
+
+        if rows:
+            local_start, goal.dtstart = rows[0][0], rows[0][1]
+            goal.materialized_until = rows[-1][1]
+        else:
+            local_start, goal.dtstart = self.now.strftime("%Y%m%d"), self.now
+
+        goal.rrule = "DTSTART:%s\n%s" % (local_start, template.rrule)
+
+        states = []
+
+        for row in rows:
+            due_date = row[3]
+            roll = self.rng.random()
+
+            if due_date is None or due_date > self.now:
+                states.append(OPEN)
+            elif roll < self.completion_rate:
+                states.append(COMPLETED)
+            elif roll < self.completion_rate + self.skip_rate:
+                states.append(SKIPPED)
+            else:
+                states.append(OPEN)
+
+        goal.streak, goal.longest_streak = streaks(states, [row[1] for row in rows], table['today'])
+
+        return goal, rows, states
+
+    def instance_rows(self, goal, rows, states):
+        for row, state in zip(rows, states):
+            if state == COMPLETED:
+                progress = goal.goal_amount
+            elif goal.incremental and state == OPEN and row[3] is not None and row[3] <= self.now:
+                progress = self.rng.randint(0, goal.goal_amount - 1)
+            else:
+                progress = 0
+
+            yield (goal.id, row[2], row[4], state == COMPLETED, progress, state == SKIPPED)
+
+    def create_round(self, prefix, first, count, goals_per_user):
+        """
+        Creates users first to first + count - 1 with their profiles, goals
+        and instances. Returns the number of instances inserted.
+        """
+        names = ["%s%d" % (prefix, i) for i in xrange(first, first + count)]
+
+        User.objects.bulk_create([User(username=name) for name in names])
+        users = list(User.objects.filter(username__in=names).order_by('id'))
+
+        zones = dict((user.id, self.rng.choice(self.timezones)) for user in users)
+        UserProfile.objects.bulk_create([UserProfile(user=user, timezone=zones[user.id]) for user in users])
+
+        if self.templates is None:
+            usercontext.activate(users[0].id, zones[users[0].id])
+
+            try:
+                self.templates = parse_templates(users[0], GOAL_TEXTS)
+                self.incremental_templates = parse_templates(users[0], INCREMENTAL_GOAL_TEXTS)
+            finally:
+                usercontext.deactivate()
+
+        plans = [self.plan_goal(user, zones[user.id]) for user in users for i in xrange(goals_per_user)]
+
+        Goal.objects.bulk_create([goal for goal, rows, states in plans], batch_size=GOAL_INSERT_BATCH)
+
+        # ids are handed out in insertion order
+        ids = Goal.objects.filter(user__in=users).order_by('id').values_list('id', flat=True)
+
+        cursor = connection.cursor()
+        batch, inserted = [], 0
+
+        for goal_id, (goal, rows, states) in zip(ids, plans):
+            goal.id = goal_id
+
+            for row in self.instance_rows(goal, rows, states):
+                batch.append(row)
+
+                if len(batch) >= INSERT_BATCH:
+                    cursor.executemany(INSERT_INSTANCES_SQL, batch)
+                    inserted += len(batch)
+                    batch = []
+
+        if batch:
+            cursor.executemany(INSERT_INSTANCES_SQL, batch)
+            inserted += len(batch)
+
+        transaction.commit_unless_managed()
+
+        return inserted
+
+def populate(users=100, goals_per_user=5, days=365, seed=0, completion_rate=0.8, skip_rate=0.05,
+             incremental_ratio=0.2, timezones=50, prefix=None, progress=None, anchor=None):
+    """
+    Creates users named prefix0, prefix1, ... (prefix defaults to
+    "load<seed>_") in up to `timezones` different timezones, each with
+    goals_per_user goals and up to `days` of history before anchor, which
+    defaults to now. Instances whose due date has passed are completed with
+    probability completion_rate and skipped with probability skip_rate;
+    stored streaks and watermarks match the generated history as of anchor.
+    The same arguments always produce the same dataset as long as anchor is
+    given too; otherwise the dates, and the timezones whose clocks skip
+    midnight within them, follow the current day. progress(users_done,
+    instances_done) is called after each round. Returns the number of
+    users, goals and instances created.
+    """
+    if prefix is None:
+        prefix = "load%d_" % seed
+
+    generator = Generator(seed, days, completion_rate, skip_rate, incremental_ratio, timezones, anchor)
+    instances = 0
+
+    for first in xrange(0, users, USERS_PER_ROUND):
+        count = min(USERS_PER_ROUND, users - first)
+        instances += generator.create_round(prefix, first, count, goals_per_user)
+
+        if progress is not None:
+            progress(first + count, instances)
+
+    return {'users': users,
+            'goals': users * goals_per_user,
+            'instances': instances}
@@ -0,0 +1,137 @@
+"""
+Query plans and latencies of the statements the dashboard and streak pages
+run, to check they are served from indexes.
+"""
+
+import re
+import time
+
+from django.db import connection, transaction
+
+from habits.benchmarks import summarize
+from habits.models import Goal, ScheduledInstance
+from habits.profiling import QueryRecorder
+
+def rolled_back(run):
+    """
+    run wrapped in a transaction that is rolled back, so write paths can be
+    explained without changing the data.
+    """
+    def wrapper():
+        with transaction.commit_manually():
+            try:
+                run()
+            finally:
+                transaction.rollback()
+
+    return wrapper
+
+def page_queries(user):
+    """
+    (name, callable) pairs for the model methods behind habits.views.main,
+    habits.views.streaks and the completion views, and for what geninstances
+    and refresh_streaks run per batch of goals.
+    """
+    goal = Goal.objects.filter(user=user).order_by('id')[0]
+    goals = Goal.objects.filter(user=user)
+
+    today = Goal.beginning_today(user)
+    todo = [instance.id for instance in Goal.instances_for_today(user)['todo']]
+
+    return [
+        ('Goal.instances_for_today', lambda: Goal.instances_for_today(user)),
+        ('Goal.with_missed_instances', lambda: Goal.with_missed_instances(user)),
+        ('Goal.past_instances_by_day', lambda: Goal.past_instances_by_day(user)),
+        ('Goal.streaks_for', lambda: Goal.streaks_for(user)),
+        ('Goal.streaks_for (goal_ids)', lambda: Goal.streaks_for(goal_ids=[goal.pk])),
+        ('Goal.current_streak', lambda: Goal.objects.get(pk=goal.pk).current_streak()),
+        ('Goal.missed_instances', lambda: Goal.objects.get(pk=goal.pk).missed_instances()),
+        ('Goal.past_instances', lambda: list(Goal.objects.get(pk=goal.pk).past_instances())),
+        ('Goal.needing_instances', lambda: list(Goal.needing_instances(today, goals))),
+        ('ScheduledInstance.insert_missing',
+         rolled_back(lambda: ScheduledInstance.insert_missing(goal.scheduled_instances(today, 5)))),
+        ('ScheduledInstance.complete_many', rolled_back(lambda: ScheduledInstance.complete_many(todo, user))),
+    ]
+
+def explain(sql, params):
+    cursor = connection.cursor()
+
+    if connection.vendor == 'sqlite':
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+
+    cursor.execute("EXPLAIN " + sql, params)
+
+    if connection.vendor == 'mysql':
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    return [row[0] for row in cursor.fetchall()]
+
+def full_scans(plan):
+    """
+    The steps of an explain() plan that read a whole table.
+    """
+    if connection.vendor == 'sqlite':
+        return [step for step in plan if re.match(r'SCAN (TABLE )?\w+', step) and 'USING' not in step]
+
+    if connection.vendor == 'mysql':
+        return ["%s (type ALL)" % step['table'] for step in plan if step.get('type') == 'ALL']
+
+    return [step.strip() for step in plan if 'Seq Scan' in step]
+
+def time_statement(sql, params, repeat):
+    cursor = connection.cursor()
+    samples = []
+
+    for i in xrange(repeat):
+        started = time.time()
+        cursor.execute(sql, params)
+        cursor.fetchall()
+        samples.append(time.time() - started)
+
+    return samples
+
+def analyze():
+    """
+    Refreshes the planner's statistics so plans reflect the loaded data.
+    """
+    cursor = connection.cursor()
+
+    if connection.vendor == 'mysql':
+        cursor.execute("ANALYZE TABLE habits_goal, habits_scheduledinstance, habits_userprofile")
+    else:
+        cursor.execute("ANALYZE")
+
+def check_plans(user, repeat=20):
+    """
+    Runs each of page_queries(user), then explains and times every distinct
+    SELECT it issued. Returns one dict per statement.
+    """
+    results = []
+
+    for name, run in page_queries(user):
+        with QueryRecorder() as recorder:
+            run()
+
+        seen = set()
+
+        for query in recorder.queries:
+            sql, params = query['sql'], query['params']
+
+            if sql in seen or params is None or not sql.lstrip().upper().startswith('SELECT'):
+                continue
+
+            seen.add(sql)
+
+            plan = explain(sql, params)
+
+            result = {'method': name,
+                      'sql': ' '.join(sql.split()),
+                      'plan': plan,
+                      'full_scans': full_scans(plan)}
+            result.update(summarize(time_statement(sql, params, repeat)))
+
+            results.append(result)
+
+    return results
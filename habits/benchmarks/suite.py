@@ -0,0 +1,141 @@
+"""
+Times the hot paths of the app against a synthetic dataset, so runs before
+and after a change can be compared.
+"""
+
+import datetime
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.client import RequestFactory
+from django.utils import timezone
+
+from habits import views
+from habits.benchmarks import data, summarize
+from habits.middleware import UserTimezoneMiddleware
+from habits.models import Goal, ScheduledInstance, parse_cache
+
+def timed(run, repeat, setup=None):
+    """
+    Runs run(i) repeat times and returns how long each call took. setup(i),
+    if given, runs before each call and isn't timed.
+    """
+    samples = []
+
+    for i in xrange(repeat):
+        if setup is not None:
+            setup(i)
+
+        started = time.time()
+        run(i)
+        samples.append(time.time() - started)
+
+    return samples
+
+class Suite(object):
+    """
+    The benchmarks, each run against a different sample user (or goal) on
+    every repetition.
+    """
+
+    def __init__(self, users, repeat):
+        self.users = users
+        self.repeat = repeat
+        self.factory = RequestFactory()
+        self.middleware = UserTimezoneMiddleware()
+
+    def user(self, i):
+        return self.users[i % len(self.users)]
+
+    def request(self, view, i, path):
+        request = self.factory.get(path)
+        request.user = self.user(i)
+
+        self.middleware.process_request(request)
+
+        try:
+            return view(request)
+        finally:
+            self.middleware.process_response(request, None)
+
+    def standard_data(self):
+        return timed(lambda i: self.request(views.standard_data, i, '/habits/'), self.repeat)
+
+    def streaks(self):
+        return timed(lambda i: self.request(views.streaks, i, '/habits/streaks/'), self.repeat)
+
+    def past_instances_by_day(self):
+        return timed(lambda i: Goal.past_instances_by_day(self.user(i)), self.repeat)
+
+    def current_streak(self):
+        loaded = {}
+
+        def load(i):
+            goals = Goal.objects.filter(user=self.user(i)).select_related('user__userprofile')
+            loaded['goal'] = goals.order_by('id')[0]
+
+        return timed(lambda i: loaded['goal'].current_streak(), self.repeat, setup=load)
+
+    def parse(self, cached):
+        def run(i):
+            goal = Goal(user=self.user(i))
+            goal.parse(data.GOAL_TEXTS[i % len(data.GOAL_TEXTS)])
+
+        def setup(i):
+            if not cached:
+                parse_cache.clear()
+
+        return timed(run, self.repeat, setup=setup)
+
+    def geninstances(self, runs):
+        """
+        Tops up every goal as geninstances does, starting from no future
+        instances each time.
+        """
+        horizon = getattr(settings, 'HABITS_MATERIALIZE_HORIZON_DAYS', 2)
+
+        def reset(i):
+            ScheduledInstance.objects.filter(date__gt=timezone.now()).delete()
+            Goal.objects.update(materialized_until=None)
+
+        def run(i):
+            now = timezone.now()
+            Goal.create_all_scheduled_instances(now, 5, Goal.needing_instances(now + datetime.timedelta(days=horizon)))
+
+        return timed(run, runs, setup=reset)
+
+    def run(self, geninstances_runs):
+        results = [
+            ('standard_data', self.standard_data()),
+            ('streaks', self.streaks()),
+            ('past_instances_by_day', self.past_instances_by_day()),
+            ('current_streak', self.current_streak()),
+            ('Goal.parse', self.parse(cached=False)),
+            ('Goal.parse (cached)', self.parse(cached=True)),
+            # changes the data, so it goes last
+            ('geninstances', self.geninstances(geninstances_runs)),
+        ]
+
+        return dict((name, summarize(samples)) for name, samples in results)
+
+def run(users=100, goals_per_user=5, years=1, repeat=20, seed=0, geninstances_runs=3):
+    """
+    Builds a throwaway database with the given shape, runs the suite against
+    it and returns the parameters, row counts and a median/p95 summary per
+    benchmark, ready to be dumped as JSON.
+    """
+    params = {'users': users, 'goals_per_user': goals_per_user, 'years': years,
+              'repeat': repeat, 'seed': seed}
+
+    with data.test_database():
+        rows = data.populate(users, goals_per_user, int(years * 365), seed)
+
+        sample = list(User.objects.filter(goal__isnull=False).distinct().order_by('id')[:repeat])
+        results = Suite(sample, repeat).run(geninstances_runs)
+
+        return {'params': params,
+                'database': connection.vendor,
+                'rows': rows,
+                'benchmarks': results}
@@ -0,0 +1,162 @@
+from functools import wraps
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from habits.ordereddict import OrderedDict
+
+# a month; versions only need to outlive what's cached under them
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+class LRUCache(object):
+    """
+    Small thread-safe, bounded, least-recently-used cache with hit/miss
+    counters. Used for process-wide memoization of expensive, pure
+    computations (compiled rrules, parse results).
+    """
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        with self._lock:
+            if key in self._data:
+                value = self._data.pop(key)
+                self._data[key] = value
+                self.hits += 1
+                return value
+
+            self.misses += 1
+
+        value = compute()
+
+        with self._lock:
+            self._data[key] = value
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+        return value
+
+    def update(self, items):
+        """
+        Stores several (key, value) pairs computed together.
+        """
+        with self._lock:
+            for key, value in items:
+                self._data.pop(key, None)
+                self._data[key] = value
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, match):
+        """
+        Drops every entry whose key satisfies match(key).
+        """
+        with self._lock:
+            for key in [k for k in self._data.keys() if match(k)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._data),
+                    'maxsize': self.maxsize,
+                    'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+    def __len__(self):
+        return len(self._data)
+
+# Per-user data versions, kept in the default Django cache. Anything
+# derived from a user's goals and instances can be cached under the current
+# version and is dropped simply by bumping it. Versions start from the
+# current time in milliseconds so that a version evicted from the cache is
+# never handed out again for different data. The cache has to be shared by
+# every process (memcached, not locmem) for versions to be consistent, which
+# a deployment declares by setting HABITS_DASHBOARD_CACHE_TIMEOUT; nothing
+# is cached across requests without it.
+
+def shared_cache_enabled():
+    return getattr(settings, 'HABITS_DASHBOARD_CACHE_TIMEOUT', 0) > 0
+
+def version_key(user_id):
+    return "habits:version:%d" % user_id
+
+def new_version():
+    return int(time.time() * 1000)
+
+def data_version(user_id):
+    key = version_key(user_id)
+    version = cache.get(key)
+
+    if version is None:
+        version = new_version()
+        cache.add(key, version, VERSION_TIMEOUT)
+
+        version = cache.get(key, version)
+
+    return version
+
+def bump_data_version(*user_ids):
+    for user_id in set(user_ids):
+        try:
+            cache.incr(version_key(user_id))
+        except ValueError:
+            cache.set(version_key(user_id), new_version(), VERSION_TIMEOUT)
+
+def cached_for_user(user_id, name, suffix, compute, timeout):
+    """
+    compute(), cached for timeout seconds under the user's current data
+    version. suffix distinguishes values that also depend on something
+    other than the user's data, like the date.
+    """
+    key = "habits:%s:%d:%d:%s" % (name, user_id, data_version(user_id), suffix)
+    value = cache.get(key)
+
+    if value is None:
+        value = compute()
+        cache.set(key, value, timeout)
+
+    return value
+
+def bumps_data_version(view):
+    """
+    Bumps the requesting user's data version once view has returned. Goes
+    outside transaction.commit_on_success, so that anything a concurrent
+    request cached from before the commit under a version bumped inside the
+    transaction is dropped too.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            bump_data_version(request.user.id)
+
+    return wrapper
+
+def user_timezone(user):
+    """
+    Name of user's timezone, cached under their data version when the cache
+    is shared so that requests don't need to load the profile.
+    """
+    if not shared_cache_enabled():
+        return user.userprofile.timezone
+
+    return cached_for_user(user.id, 'timezone', '', lambda: user.userprofile.timezone, VERSION_TIMEOUT)
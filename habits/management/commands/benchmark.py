@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import json
+
+from habits.benchmarks import suite
+import sys
+
+class Command(BaseCommand):
+    args = '(none)'
+    help = ('Builds a synthetic database in a throwaway test database and reports median and p95 '
+            'timings of the dashboard, streaks, parsing and geninstances as JSON')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', dest='users', default=100,
+                    help='Number of users to generate'),
+        make_option('--goals', type='int', dest='goals', default=5,
+                    help='Number of goals per user'),
+        make_option('--years', type='float', dest='years', default=1,
+                    help='Years of instance history per goal'),
+        make_option('--repeat', type='int', dest='repeat', default=20,
+                    help='Number of timed runs of each benchmark'),
+        make_option('--geninstances-runs', type='int', dest='geninstances_runs', default=3,
+                    help='Number of timed runs of geninstances, which tops up every goal each time'),
+        make_option('--seed', type='int', dest='seed', default=0,
+                    help='Random seed for the generated data'),
+        make_option('--output', dest='output', default=None,
+                    help='Write the JSON report to this file instead of stdout'),
+    )
+
+    def handle(self, *args, **options):
+        if options['users'] < 1 or options['goals'] < 1 or options['repeat'] < 1:
+            raise CommandError("--users, --goals and --repeat must be at least 1")
+
+        print >>sys.stderr, "Building the synthetic database and running benchmarks..."
+
+        report = suite.run(options['users'], options['goals'], options['years'], options['repeat'],
+                           options['seed'], options['geninstances_runs'])
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + "\n")
+        else:
+            print output
+
+        print >>sys.stderr, "Done."
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from optparse import make_option
+import json
+
+from habits.benchmarks import data, plans
+import sys
+
+class Command(BaseCommand):
+    args = '(none)'
+    help = ('Loads a synthetic dataset into a throwaway test database and reports the query plan '
+            'and latency of every statement behind the dashboard and streak pages as JSON')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', dest='users', default=200,
+                    help='Number of users to generate'),
+        make_option('--goals', type='int', dest='goals', default=5,
+                    help='Number of goals per user'),
+        make_option('--days', type='int', dest='days', default=365,
+                    help='Days of instance history per goal'),
+        make_option('--seed', type='int', dest='seed', default=0,
+                    help='Random seed for the generated data'),
+        make_option('--repeat', type='int', dest='repeat', default=20,
+                    help='Number of times each statement is timed'),
+    )
+
+    def handle(self, *args, **options):
+        with data.test_database():
+            print >>sys.stderr, "Loading synthetic data..."
+
+            counts = data.populate(options['users'], options['goals'], options['days'], options['seed'])
+
+            print >>sys.stderr, "Loaded %(users)d users, %(goals)d goals, %(instances)d instances." % counts
+
+            plans.analyze()
+
+            user = User.objects.filter(goal__isnull=False).order_by('id')[0]
+            results = plans.check_plans(user, options['repeat'])
+
+        print json.dumps({'rows': counts, 'queries': results}, indent=2)
+
+        scans = [result for result in results if result['full_scans']]
+
+        for result in scans:
+            print >>sys.stderr, "%s: %s" % (result['method'], ", ".join(result['full_scans']))
+
+        if scans:
+            raise CommandError("%d statements read whole tables" % len(scans))
@@ -1,22 +1,115 @@
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.conf import settings
+from optparse import make_option
+from multiprocessing import Pool
 import datetime
 import logging
+import time
 
 from habits.models import Goal
 import sys
 
+def shard_goals(goals, shard):
+    if shard is None:
+        return goals
+
+    index, count = shard
+
+    return goals.extra(where=['habits_goal.id %% %s = %s'], params=[count, index])
+
+def id_ranges(ids, workers):
+    """
+    Splits a sorted list of ids into at most `workers` contiguous
+    (first, last) ranges of roughly equal size.
+    """
+    size = max(1, -(-len(ids) // workers))
+
+    return [(ids[i], ids[min(i + size, len(ids)) - 1]) for i in xrange(0, len(ids), size)]
+
+def goals_to_process(shard, horizon_end):
+    return shard_goals(Goal.needing_instances(horizon_end), shard)
+
+def generate_range(args):
+    worker, first_id, last_id, shard, horizon_end, start, n = args
+
+    started = time.time()
+
+    goals = goals_to_process(shard, horizon_end).filter(id__gte=first_id, id__lte=last_id)
+    processed = goals.count()
+
+    created, skipped = Goal.create_all_scheduled_instances(start, n, goals)
+
+    return worker, processed, created, skipped, time.time() - started
+
 class Command(BaseCommand):
     args = '(none)'
     help = 'Generates additional scheduled instances of goals'
 
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=1,
+                    help='Number of worker processes to split the goals between'),
+        make_option('--shard', dest='shard', default=None,
+                    help='Only process shard i of k (goal id modulo k), given as i/k'),
+        make_option('--horizon', type='float', dest='horizon',
+                    default=getattr(settings, 'HABITS_MATERIALIZE_HORIZON_DAYS', 2),
+                    help='Only process goals with fewer than this many days of instances generated ahead'),
+    )
+
+    def parse_shard(self, value):
+        if value is None:
+            return None
+
+        try:
+            index, count = [int(part) for part in value.split('/')]
+        except ValueError:
+            raise CommandError("--shard must look like i/k, e.g. 0/4")
+
+        if count < 1 or not (0 <= index < count):
+            raise CommandError("--shard index must be between 0 and k - 1")
+
+        return index, count
+
     def handle(self, *args, **options):
         from django.utils import timezone
 
+        workers = options['workers']
+        shard = self.parse_shard(options['shard'])
+
+        if workers < 1:
+            raise CommandError("--workers must be at least 1")
+
         print >>sys.stderr, "Generating additional scheduled instances..."
 
         today = timezone.now()
+        horizon_end = today + datetime.timedelta(days=options['horizon'])
+
+        ids = list(goals_to_process(shard, horizon_end).order_by('id').values_list('id', flat=True))
+        jobs = [(worker, first_id, last_id, shard, horizon_end, today, 5) for
+                worker, (first_id, last_id) in enumerate(id_ranges(ids, workers))]
+
+        if workers == 1:
+            results = [generate_range(job) for job in jobs]
+        else:
+            # forked workers must open their own connections rather than
+            # share the parent's socket
+            connection.close()
+
+            pool = Pool(workers)
+
+            try:
+                results = pool.map(generate_range, jobs)
+            finally:
+                pool.close()
+                pool.join()
+
+        total_created, total_skipped = 0, 0
 
-        Goal.create_all_scheduled_instances(today, 5)
+        for worker, processed, created, skipped, elapsed in results:
+            print >>sys.stderr, "worker %d: %d goals, %d instances inserted, %d already existed, %.2fs" % \
+                (worker, processed, created, skipped, elapsed)
 
-        print >>sys.stderr, "Done generating scheduled instances."
+            total_created += created
+            total_skipped += skipped
 
+        print >>sys.stderr, "Done generating scheduled instances (%d created, %d already existed)." % (total_created, total_skipped)
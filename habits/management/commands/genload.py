@@ -0,0 +1,81 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+import datetime
+import pytz
+import time
+
+from habits.benchmarks import data
+import sys
+
+class Command(BaseCommand):
+    args = '(none)'
+    help = ('Fills the database with generated users, goals and instance history using bulk inserts. '
+            'The same options, seed and --anchor always produce the same data')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--users', type='int', dest='users', default=1000,
+                    help='Number of users to generate'),
+        make_option('--goals', type='int', dest='goals', default=5,
+                    help='Number of goals per user'),
+        make_option('--days', type='int', dest='days', default=365,
+                    help='Days of instance history before now'),
+        make_option('--seed', type='int', dest='seed', default=0,
+                    help='Random seed'),
+        make_option('--timezones', type='int', dest='timezones', default=50,
+                    help='Number of different timezones users are spread over'),
+        make_option('--completion-rate', type='float', dest='completion_rate', default=0.8,
+                    help='Fraction of past instances that are completed'),
+        make_option('--skip-rate', type='float', dest='skip_rate', default=0.05,
+                    help='Fraction of past instances that are skipped'),
+        make_option('--incremental-ratio', type='float', dest='incremental_ratio', default=0.2,
+                    help='Fraction of goals that are incremental ("20 times every day")'),
+        make_option('--anchor', dest='anchor', default=None,
+                    help='UTC date or time (YYYY-MM-DD[THH:MM:SS]) the history ends at instead of now, '
+                         'to reproduce a dataset on another day'),
+        make_option('--prefix', dest='prefix', default=None,
+                    help='Username prefix, load<seed>_ by default; must not be in use already'),
+    )
+
+    def handle(self, *args, **options):
+        from django.contrib.auth.models import User
+
+        for name in ['users', 'goals', 'timezones']:
+            if options[name] < 1:
+                raise CommandError("--%s must be at least 1" % name)
+
+        for name in ['completion_rate', 'skip_rate', 'incremental_ratio']:
+            if not (0 <= options[name] <= 1):
+                raise CommandError("--%s must be between 0 and 1" % name.replace('_', '-'))
+
+        if options['completion_rate'] + options['skip_rate'] > 1:
+            raise CommandError("--completion-rate and --skip-rate can't add up to more than 1")
+
+        anchor = None
+
+        if options['anchor']:
+            for format in ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"]:
+                try:
+                    anchor = datetime.datetime.strptime(options['anchor'], format).replace(tzinfo=pytz.utc)
+                    break
+                except ValueError:
+                    pass
+            else:
+                raise CommandError("--anchor must be a date like 2013-01-31 or a time like 2013-01-31T12:00:00")
+
+        prefix = options['prefix'] or "load%d_" % options['seed']
+
+        if User.objects.filter(username__startswith=prefix).exists():
+            raise CommandError("There are already users named %s..., pick another --prefix or --seed" % prefix)
+
+        print >>sys.stderr, "Generating %d users with %d goals each..." % (options['users'], options['goals'])
+
+        started = time.time()
+
+        def progress(users, instances):
+            print >>sys.stderr, "%d users, %d instances, %.1fs" % (users, instances, time.time() - started)
+
+        counts = data.populate(options['users'], options['goals'], options['days'], options['seed'],
+                               options['completion_rate'], options['skip_rate'], options['incremental_ratio'],
+                               options['timezones'], prefix, progress, anchor)
+
+        print >>sys.stderr, "Done generating %(users)d users, %(goals)d goals and %(instances)d instances." % counts
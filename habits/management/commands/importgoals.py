@@ -0,0 +1,86 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import transaction
+from optparse import make_option
+import csv
+import pytz
+
+from habits.models import Goal
+import sys
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ('Creates goals in bulk. Reads one goal text per line for --user, or CSV rows of '
+            'user,timezone,goal text otherwise. Use - to read from standard input.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--user', dest='user', default=None,
+                    help='Username to create every goal for; the file then holds one goal text per line'),
+    )
+
+    def read_lines(self, source, username):
+        """
+        Groups the input into {username: (timezone or None, [(line number, goal text)])}.
+        """
+        by_user = {}
+
+        if username:
+            lines = [(number, line.strip()) for number, line in enumerate(source, 1) if line.strip()]
+            by_user[username] = (None, lines)
+
+            return by_user
+
+        for number, row in enumerate(csv.reader(source), 1):
+            if not row or not ''.join(row).strip():
+                continue
+
+            if len(row) != 3:
+                raise CommandError("line %d: expected user,timezone,goal text" % number)
+
+            username, tz_name, goal_text = [column.strip() for column in row]
+
+            if tz_name and tz_name not in pytz.all_timezones_set:
+                raise CommandError("line %d: unknown timezone %s" % (number, tz_name))
+
+            timezone, lines = by_user.setdefault(username, (tz_name or None, []))
+            lines.append((number, goal_text))
+
+        return by_user
+
+    @transaction.commit_on_success
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give the file to import, or - for standard input")
+
+        source = sys.stdin if args[0] == '-' else open(args[0])
+
+        try:
+            by_user = self.read_lines(source, options['user'])
+        finally:
+            if source is not sys.stdin:
+                source.close()
+
+        created, failed = 0, 0
+
+        for username, (tz_name, lines) in sorted(by_user.items()):
+            user, new_user = User.objects.get_or_create(username=username)
+
+            profile = user.userprofile
+
+            if tz_name and profile.timezone != tz_name:
+                old_tz_name = profile.timezone
+                profile.timezone = tz_name
+                profile.save()
+
+                # same as views.update_tz, so existing instances follow
+                Goal.rebase_timezone(user, old_tz_name, tz_name)
+
+            goals, errors = Goal.import_goals(user, lines)
+
+            for number, error in errors:
+                print >>sys.stderr, "line %d: %s" % (number, error.value)
+
+            created += len(goals)
+            failed += len(errors)
+
+        print >>sys.stderr, "Imported %d goals, %d lines had errors." % (created, failed)
@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from habits.models import Goal
+from habits import cache
+import sys
+
+class Command(BaseCommand):
+    args = '(none)'
+    help = 'Rebuilds the stored streak counters of goals from their history'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--check', action='store_true', dest='check', default=False,
+                    help="Only report goals whose stored streak doesn't match current_streak()"),
+        make_option('--rollover', action='store_true', dest='rollover', default=False,
+                    help='Only update goals with a running streak, which is all a new day can change; '
+                         'meant to run hourly, as users\' days end at different times'),
+    )
+
+    def handle(self, *args, **options):
+        goals = Goal.objects.all().select_related('user__userprofile').order_by('id')
+
+        if options['check']:
+            mismatched = 0
+
+            for goal in goals.iterator():
+                expected = goal.current_streak()
+
+                if goal.streak != expected:
+                    mismatched += 1
+                    print >>sys.stderr, "goal %d: stored streak %d, current_streak() %d" % (goal.id, goal.streak, expected)
+
+            print >>sys.stderr, "%d goals with a stale streak." % mismatched
+
+            if mismatched:
+                raise CommandError("Stored streaks are out of date")
+
+            return
+
+        if options['rollover']:
+            print >>sys.stderr, "Recomputing streaks of all goals..."
+
+            stored = dict((goal_id, (streak, user_id)) for goal_id, streak, user_id in
+                          goals.filter(streak__gt=0).values_list('id', 'streak', 'user'))
+            by_streak = {}
+            user_ids = set()
+
+            for goal_id, streak in Goal.streaks_for().items():
+                if goal_id in stored and stored[goal_id][0] != streak:
+                    by_streak.setdefault(streak, []).append(goal_id)
+                    user_ids.add(stored[goal_id][1])
+
+            for streak, ids in by_streak.items():
+                for i in xrange(0, len(ids), Goal.INSERT_BATCH_GOALS):
+                    Goal.objects.filter(id__in=ids[i:i + Goal.INSERT_BATCH_GOALS]).update(streak=streak)
+
+            cache.bump_data_version(*user_ids)
+        else:
+            print >>sys.stderr, "Rebuilding streaks from history..."
+
+            for goal in goals.iterator():
+                streak, longest = goal.streaks_from_history()
+
+                Goal.objects.filter(pk=goal.pk).update(streak=streak, longest_streak=longest)
+
+                cache.bump_data_version(goal.user_id)
+
+        print >>sys.stderr, "Done."
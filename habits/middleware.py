@@ -0,0 +1,101 @@
+from django.conf import settings
+
+from habits import cache, usercontext
+from habits.profiling import QueryRecorder
+import json
+import logging
+import random
+import time
+
+logger = logging.getLogger('habits.querystats')
+
+class UserTimezoneMiddleware(object):
+    """
+    Looks up the logged in user's timezone once, from the cache when it can,
+    and makes it and their local midnight available to the models for the
+    rest of the request. Must come after AuthenticationMiddleware.
+    """
+
+    def process_request(self, request):
+        usercontext.deactivate()
+
+        if request.user.is_authenticated():
+            usercontext.activate(request.user.id, cache.user_timezone(request.user))
+
+    def process_response(self, request, response):
+        usercontext.deactivate()
+
+        return response
+
+class QueryStatsMiddleware(object):
+    """
+    Measures how many statements a request ran, how long they took, the
+    slowest of them and the wall time of the whole request. Adds them as
+    X-Query-* headers when HABITS_QUERY_STATS_HEADERS is on and writes a
+    JSON line to the habits.querystats logger for a HABITS_QUERY_STATS_SAMPLE_RATE
+    fraction of requests. Requests that are neither are not instrumented.
+    Should come first so the session and auth queries are counted.
+    """
+
+    SLOWEST_SQL_LENGTH = 200
+
+    def shorten(self, sql):
+        """
+        sql on one line, cut to SLOWEST_SQL_LENGTH characters, as unicode;
+        statements can also come in as byte strings.
+        """
+        if not isinstance(sql, unicode):
+            sql = sql.decode('utf-8', 'replace')
+
+        return u" ".join(sql.split())[:self.SLOWEST_SQL_LENGTH]
+
+    def process_request(self, request):
+        headers = getattr(settings, 'HABITS_QUERY_STATS_HEADERS', False)
+        sampled = random.random() < getattr(settings, 'HABITS_QUERY_STATS_SAMPLE_RATE', 0)
+
+        if not (headers or sampled):
+            return
+
+        request._query_stats = {'headers': headers, 'sampled': sampled,
+                                'view': None, 'started': time.time()}
+        request._query_recorder = QueryRecorder().__enter__()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if hasattr(request, '_query_stats'):
+            request._query_stats['view'] = "%s.%s" % (view_func.__module__, view_func.__name__)
+
+    def process_response(self, request, response):
+        recorder = getattr(request, '_query_recorder', None)
+
+        if recorder is None:
+            return response
+
+        recorder.__exit__(None, None, None)
+        del request._query_recorder
+
+        options = request._query_stats
+        slowest = recorder.slowest()
+
+        stats = {'view': options['view'],
+                 'path': request.path,
+                 'method': request.method,
+                 'status': response.status_code,
+                 'queries': recorder.count,
+                 'sql_ms': round(recorder.total_time * 1000, 2),
+                 'wall_ms': round((time.time() - options['started']) * 1000, 2),
+                 'slowest_ms': round(slowest['time'] * 1000, 2) if slowest else None,
+                 'slowest_sql': self.shorten(slowest['sql']) if slowest else None}
+
+        if options['headers']:
+            response['X-Query-Count'] = str(stats['queries'])
+            response['X-Query-Time'] = "%.2fms" % stats['sql_ms']
+            response['X-Response-Time'] = "%.2fms" % stats['wall_ms']
+
+            if slowest:
+                response['X-Slowest-Query'] = "%.2fms %s" % (stats['slowest_ms'],
+                                                             stats['slowest_sql'].encode('ascii', 'replace'))
+
+        if options['sampled']:
+            logger.info(json.dumps(stats))
+
+        return response
@@ -3,28 +3,21 @@ import datetime
 from south.db import db
 from south.v2 import DataMigration
 from django.db import models
-from habits.models import Goal
 
 class Migration(DataMigration):
 
     def forwards(self, orm):
-        from django.contrib.auth.models import User
-        from habits.models import UserProfile
-    
-        UserProfile.objects.all().delete()
+        orm.UserProfile.objects.all().delete()
 
-        for user in User.objects.all():
-            print "Creating userprofile for user", user
-            profile = UserProfile()
-            profile.user = user
-            profile.save()
+        for user in orm['auth.User'].objects.all():
+            print "Creating userprofile for user", user.username
+            orm.UserProfile.objects.create(user=user)
 
         from django.utils import timezone
         orm.ScheduledInstance.objects.filter(date__gt=timezone.now()).delete()
-        
-        today = timezone.now()
 
-        Goal.create_all_scheduled_instances(today, 5)
+        # only the frozen models are safe to use here; the next geninstances
+        # run recreates the future instances deleted above
 
     def backwards(self, orm):
         print "Nothing to do"
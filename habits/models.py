@@ -3,18 +3,36 @@ from django.utils import timezone
 
 import itertools
 import datetime
+import calendar
+import bisect
 import sys
 import re
 import string
 import pytz
+import threading
 
 from dateutil import rrule
 from recurrent import RecurringEvent
 from django.contrib.auth.models import User
-from django.db import IntegrityError
-from django.db.models.signals import post_save
+from django.db import IntegrityError, transaction, connection
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete, post_init, pre_delete
+from django.conf import settings
 
-from habits.ordereddict import OrderedDict
+from habits.cache import LRUCache
+from habits import cache, usercontext
+
+# compiled rrules keyed on (rrule text, timezone name), shared by every goal
+# in the process so geninstances doesn't reparse the same rule over and over
+rrule_cache = LRUCache(getattr(settings, 'HABITS_RRULE_CACHE_SIZE', 1024))
+
+# results of parsing the recurrence part of goal texts; most users type one
+# of a handful of phrases
+parse_cache = LRUCache(getattr(settings, 'HABITS_PARSE_CACHE_SIZE', 256))
+
+# due dates keyed on (rrule text, timezone name, instance date), filled a
+# goal's worth of instances at a time by ScheduledInstance.compute_due_date
+due_date_cache = LRUCache(getattr(settings, 'HABITS_DUE_DATE_CACHE_SIZE', 4096))
 
 class InvalidInput(Exception):
     def __init__(self, value):
@@ -35,34 +53,66 @@ class UserProfile(models.Model):
         else:
             return tzstr
 
+    # (choices, choice dict, UTC time of the next offset change), built lazily
+    _timezone_table = None
+
     @classmethod
-    def pretty_timezone_choices(self):
-        ALL_TIMEZONE_CHOICES = tuple(zip(pytz.all_timezones, pytz.all_timezones))
-        COMMON_TIMEZONE_CHOICES = tuple(zip(pytz.common_timezones, pytz.common_timezones))
-        PRETTY_TIMEZONE_CHOICES = []
-
-        for tz in pytz.common_timezones:
-            now = datetime.datetime.now(pytz.timezone(tz))
-            ofs = now.strftime("%z")
-            PRETTY_TIMEZONE_CHOICES.append((int(ofs), tz, "(GMT%s) %s" % (ofs, UserProfile.readable_tz(tz))))
-    
-        PRETTY_TIMEZONE_CHOICES.sort()
-    
-        for i in xrange(len(PRETTY_TIMEZONE_CHOICES)):
-            PRETTY_TIMEZONE_CHOICES[i] = PRETTY_TIMEZONE_CHOICES[i][1:]
-    
-        return PRETTY_TIMEZONE_CHOICES
+    def next_transition(self, tz, now):
+        transitions = getattr(tz, '_utc_transition_times', None)
+
+        if not transitions:
+            return None
+
+        index = bisect.bisect_right(transitions, now)
+
+        if index < len(transitions):
+            return transitions[index]
+
+        return None
 
     @classmethod
-    def pretty_timezone_dict(self):
-        choices = UserProfile.pretty_timezone_choices()
+    def build_timezone_table(self, now):
+        choices = []
+        valid_until = datetime.datetime.max
+
+        for tz_name in pytz.common_timezones:
+            tz = pytz.timezone(tz_name)
+            ofs = pytz.utc.localize(now).astimezone(tz).strftime("%z")
+            choices.append((int(ofs), tz_name, "(GMT%s) %s" % (ofs, UserProfile.readable_tz(tz_name))))
+
+            transition = UserProfile.next_transition(tz, now)
+
+            if transition is not None and transition < valid_until:
+                valid_until = transition
+
+        choices.sort()
+        choices = [choice[1:] for choice in choices]
+
+        return choices, dict(choices), valid_until
+
+    @classmethod
+    def timezone_table(self):
+        """
+        The timezone choices only change when some zone's UTC offset does, so
+        they are built once per process and rebuilt after the next DST
+        transition of any common timezone.
+        """
+        now = datetime.datetime.utcnow()
+        table = UserProfile._timezone_table
 
-        choice_dict = {}
+        if table is None or now >= table[2]:
+            table = UserProfile.build_timezone_table(now)
+            UserProfile._timezone_table = table
 
-        for choice in choices:
-            choice_dict[choice[0]] = choice[1]
-        
-        return choice_dict
+        return table
+
+    @classmethod
+    def pretty_timezone_choices(self):
+        return UserProfile.timezone_table()[0]
+
+    @classmethod
+    def pretty_timezone_dict(self):
+        return UserProfile.timezone_table()[1]
 
     def readable(self):
         return UserProfile.pretty_timezone_dict()[self.timezone]
@@ -76,9 +126,29 @@ def create_user_profile(sender, instance, created, **kwargs):
 
 post_save.connect(create_user_profile, sender=User)
 
+def refresh_user_context(sender, instance, **kwargs):
+    if usercontext.current(instance.user_id) is not None:
+        usercontext.activate(instance.user_id, instance.timezone)
+
+post_save.connect(refresh_user_context, sender=UserProfile)
+
+def bump_profile_owner(sender, instance, **kwargs):
+    # the cached timezone lives under the user's data version
+    cache.bump_data_version(instance.user_id)
+
+post_save.connect(bump_profile_owner, sender=UserProfile)
+
 class Goal(models.Model):
     EVERY = "every"
 
+    # goals whose instances are checked and inserted (or whose streaks are
+    # refreshed) per round trip
+    INSERT_BATCH_GOALS = 200
+
+    # goals whose streak counters are written per UPDATE; at six parameters
+    # each this stays under sqlite's limit of 999
+    UPDATE_BATCH_GOALS = 150
+
     number_words = { 'one':   1, 'eleven':     11,
                  'two':   2, 'twelve':     12,
                  'three': 3, 'thirteen':   13,
@@ -111,16 +181,42 @@ class Goal(models.Model):
     incremental = models.BooleanField(default=False)
     goal_amount = models.IntegerField(default=0)
 
+    # date of the latest scheduled instance generated for this goal
+    materialized_until = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    # cached results of current_streak() and the best streak seen so far,
+    # kept up to date by refresh_streaks()
+    streak = models.IntegerField(default=0)
+    longest_streak = models.IntegerField(default=0)
+
     @classmethod
     def beginning_today(self, user):
-        local_tz = pytz.timezone(user.userprofile.timezone)
+        context = usercontext.current(user.id)
+
+        if context is not None:
+            return context.beginning_today
+
+        return usercontext.local_midnight_utc(pytz.timezone(user.userprofile.timezone))
 
-        now_utc = timezone.now()
-        now_local = now_utc.astimezone(local_tz)
-        local_midnight = now_local.replace(hour=0, minute=0, second=0, microsecond=0)
-        local_midnight_utc = local_midnight.astimezone(pytz.utc)
+    def today(self):
+        """
+        Beginning of today for the goal's owner. Avoids loading self.user
+        when the owner's timezone is already known for this request.
+        """
+        context = usercontext.current(self.user_id)
 
-        return local_midnight_utc
+        if context is not None:
+            return context.beginning_today
+
+        return Goal.beginning_today(self.user)
+
+    def tz_name(self):
+        context = usercontext.current(self.user_id)
+
+        if context is not None:
+            return context.tz_name
+
+        return self.user.userprofile.timezone
 
     def incremental_parse(self, description):
         description_words = description.split()
@@ -145,6 +241,11 @@ class Goal(models.Model):
 
     @classmethod
     def user_tz(self, user):
+        context = usercontext.current(user.id)
+
+        if context is not None:
+            return context.tz
+
         return pytz.timezone(user.userprofile.timezone)
 
     def parse(self, goal_text):
@@ -170,28 +271,12 @@ class Goal(models.Model):
 
         recurring_text = goal_text[index:].strip()
 
-        recurring_event = RecurringEvent()
-
-        result = None
+        params, rfc_rrule = Goal.parse_recurrence(recurring_text, Goal.beginning_today(self.user))
 
-        try:
-            result = recurring_event.parse(recurring_text)
-        except ValueError:
-            raise InvalidInput("Not a recurring rule or not valid input")
-
-        if type(result) != type('str'):
-            raise InvalidInput("Not a recurring rule or not valid input")
-
-        params = recurring_event.get_params()
-
-        if params['freq'] in ['hourly', 'minutely', 'secondly']:
-            raise InvalidInput("Not a recurring rule or not valid input")
-
-        
         if params.has_key('dtstart'):
             naive = datetime.datetime.strptime(params['dtstart'], "%Y%m%d") 
 
-            user_tz = pytz.timezone(self.user.userprofile.timezone)
+            user_tz = Goal.user_tz(self.user)
 
             local_dt = user_tz.localize(naive, is_dst=None)
             utc_dt = local_dt.astimezone (pytz.utc)
@@ -200,7 +285,7 @@ class Goal(models.Model):
         else:
             self.dtstart = Goal.beginning_today(self.user)
 
-        self.rrule = recurring_event.get_RFC_rrule()
+        self.rrule = rfc_rrule
 
         if not self.rrule.startswith("DTSTART:"):
             self.rrule = "DTSTART:" + self.dtstart.strftime("%Y%m%d") + "\n" + self.rrule
@@ -211,10 +296,58 @@ class Goal(models.Model):
         if params.get('byday', None):
             self.byday = params['byday']
 
+    @classmethod
+    def run_recurrent(self, recurring_text):
+        """
+        Returns (params, RFC rrule) for recurring_text, or an error message.
+        """
+        recurring_event = RecurringEvent()
+
+        result = None
+
+        try:
+            result = recurring_event.parse(recurring_text)
+        except ValueError:
+            return "Not a recurring rule or not valid input"
+
+        if type(result) != type('str'):
+            return "Not a recurring rule or not valid input"
+
+        params = recurring_event.get_params()
+
+        if params['freq'] in ['hourly', 'minutely', 'secondly']:
+            return "Not a recurring rule or not valid input"
+
+        return params, recurring_event.get_RFC_rrule()
+
+    @classmethod
+    def parse_recurrence(self, recurring_text, today):
+        """
+        Memoized run_recurrent. Entries are keyed on the normalized text, the
+        user's local day and the server's day (which recurrent resolves
+        relative dates against), so "starting tomorrow" never outlives the day
+        it was parsed on. Raises InvalidInput for unparseable text.
+        """
+        normalized = " ".join(recurring_text.lower().split())
+        key = (normalized, today, datetime.date.today())
+
+        result = parse_cache.get(key, lambda: Goal.run_recurrent(normalized))
+
+        if isinstance(result, basestring):
+            raise InvalidInput(result)
+
+        params, rfc_rrule = result
+
+        return dict(params), rfc_rrule
+
+    @classmethod
+    def compiled_rrule(self, rrule_text, tz_name):
+        return rrule_cache.get((rrule_text, tz_name),
+                               lambda: (rrule.rrulestr(rrule_text), pytz.timezone(tz_name)))
+
     def next_date(self, last_date):
-        rr = rrule.rrulestr(self.rrule)
-        
-        user_tz = pytz.timezone(self.user.userprofile.timezone)
+        rr, user_tz = Goal.compiled_rrule(self.rrule, self.tz_name())
+
         last_date_local = last_date.astimezone(user_tz)
         last_date_naive = last_date_local.replace(tzinfo=None)
         next_date_naive = rr.after(last_date_naive)
@@ -226,65 +359,325 @@ class Goal(models.Model):
 
         return next_date_utc
 
-    def generate_next_scheduled_instances(self, start, n):
+    def due_next_day(self):
+        """
+        Weekly rules with specific days and monthly rules with a specific day
+        of the month are due the day after they are scheduled instead of at
+        the next occurrence.
+        """
+        return ("BYDAY=" in self.rrule and "FREQ=WEEKLY" in self.rrule) or \
+               ("BYMONTHDAY=" in self.rrule and "FREQ=MONTHLY" in self.rrule)
+
+    def occurrences(self, start):
+        """
+        Lazily yields (date, due_date) pairs for every occurrence on or after
+        the day of start, expanding the rule in a single pass.
+        """
+        rr, user_tz = Goal.compiled_rrule(self.rrule, self.tz_name())
 
-        datetimes = []
+        last_date = start - datetime.timedelta(days=1)
+        last_date_naive = last_date.astimezone(user_tz).replace(tzinfo=None)
 
-        for i in range(0, n):
-            if len(datetimes) == 0:
-                last_date = start - datetime.timedelta(days=1)
+        next_day_due = self.due_next_day()
+
+        def to_utc(naive):
+            return timezone.make_aware(naive, user_tz).astimezone(pytz.utc)
+
+        local_dates = itertools.dropwhile(lambda d: d <= last_date_naive, rr)
+
+        current = next(local_dates, None)
+
+        while current is not None:
+            following = next(local_dates, None)
+
+            date = to_utc(current)
+
+            if next_day_due:
+                due_date = date + datetime.timedelta(days=1)
+            elif following is not None:
+                due_date = to_utc(following)
             else:
-                last_date = datetimes[-1]
+                due_date = None
 
-            datetimes.append(self.next_date(last_date))
+            yield date, due_date
+
+            current = following
+
+    def generate_next_scheduled_instances(self, start, n):
+        return [date for date, due_date in itertools.islice(self.occurrences(start), n)]
+
+    @classmethod
+    def virtual_instances_enabled(self):
+        return getattr(settings, 'HABITS_VIRTUAL_INSTANCES', False)
 
-        return [dt for dt in datetimes]
+    def scheduled_instances(self, start, n):
+        occurrences = itertools.islice(self.occurrences(start), n)
+
+        if Goal.virtual_instances_enabled():
+            # future occurrences are computed on read instead of stored
+            now = timezone.now()
+            occurrences = itertools.takewhile(lambda occurrence: occurrence[0] <= now, occurrences)
+
+        return [ScheduledInstance(goal=self, date=date, due_date=due_date) for
+                date, due_date in occurrences]
+
+    def current_virtual_instance(self, today):
+        """
+        The occurrence that is due today, computed from the rule rather than
+        loaded from the database. None if nothing is due today.
+        """
+        rr, user_tz = Goal.compiled_rrule(self.rrule, self.tz_name())
+
+        local_date = rr.before(today.astimezone(user_tz).replace(tzinfo=None), inc=True)
+
+        if local_date is None:
+            return None
+
+        start = timezone.make_aware(local_date, user_tz).astimezone(pytz.utc)
+        date, due_date = next(self.occurrences(start))
+
+        if due_date is None or due_date <= today:
+            return None
+
+        return VirtualInstance(self, date, due_date)
 
     def create_scheduled_instances(self, start, n):
-        dates = self.generate_next_scheduled_instances(start, n)
-        instances = [ScheduledInstance(goal=self, date=d) for d in dates]
+        return ScheduledInstance.insert_missing(self.scheduled_instances(start, n))
+
+    @classmethod
+    def import_goals(self, user, lines):
+        """
+        Parses a batch of goal texts for user, creates the valid goals and
+        bulk-creates their first scheduled instances. lines is a list of
+        (line number, goal text). Returns (goals, errors), errors being a list
+        of (line number, InvalidInput).
+        """
+        goals, errors = [], []
+
+        for line_number, goal_text in lines:
+            goal = Goal()
+            goal.user = user
 
-        for instance in instances:
             try:
-                instance.due_date = instance.compute_due_date()
-                instance.save()
-            except IntegrityError:
-                pass
+                if len(goal_text) > Goal._meta.get_field('creation_text').max_length:
+                    raise InvalidInput("Goal text is too long")
+
+                goal.parse(goal_text)
+
+                if len(goal.description) > Goal._meta.get_field('description').max_length:
+                    raise InvalidInput("Goal description is too long")
+            except InvalidInput as e:
+                errors.append((line_number, e))
+                continue
+            except Exception:
+                errors.append((line_number, InvalidInput("Invalid goal. Please enter a correctly formatted goal.")))
+                continue
+
+            goals.append(goal)
+
+        if not goals:
+            return [], errors
+
+        # saved one by one rather than bulk-created, which doesn't hand back
+        # the primary keys the instances need
+        for goal in goals:
+            goal.save()
+
+        today = Goal.beginning_today(user)
+        instances = []
+
+        for goal in goals:
+            instances.extend(goal.scheduled_instances(today, 5))
+
+        ScheduledInstance.insert_missing(instances)
+
+        cache.bump_data_version(user.id)
+
+        return goals, errors
 
     @classmethod
-    def create_all_scheduled_instances(self, start, n):
-        for goal in Goal.objects.all():
-            goal.create_scheduled_instances(start, n)
+    def needing_instances(self, horizon_end, goals=None):
+        """
+        Goals whose materialized instances run out before horizon_end.
+        """
+        if goals is None:
+            goals = Goal.objects.all()
+
+        return goals.filter(models.Q(materialized_until__isnull=True) |
+                            models.Q(materialized_until__lt=horizon_end))
 
     @classmethod
-    def skipped_goals_for_today(self, user):
-        today = Goal.beginning_today(user)
+    def advance_watermarks(self, instances):
+        """
+        Moves materialized_until forward to the latest date in instances for
+        each goal, with one UPDATE per batch of goals.
+        """
+        latest = {}
+
+        for instance in instances:
+            if instance.goal_id not in latest or instance.date > latest[instance.goal_id]:
+                latest[instance.goal_id] = instance.date
 
-        instances = [goal.scheduledinstance_set.filter(date__lte=today,
-            due_date__gt=today,
-            skipped=True) for
-                     goal in Goal.objects.filter(user=user)]
-        return list(itertools.chain.from_iterable(instances))
+        goal_ids = sorted(latest)
+        cursor = connection.cursor()
+
+        for i in xrange(0, len(goal_ids), self.INSERT_BATCH_GOALS):
+            batch = goal_ids[i:i + self.INSERT_BATCH_GOALS]
+            params = []
+
+            for goal_id in batch:
+                date = connection.ops.value_to_db_datetime(latest[goal_id])
+                params.extend([goal_id, date, date])
+
+            cursor.execute("""
+                UPDATE habits_goal
+                SET materialized_until = CASE %s ELSE materialized_until END
+                WHERE id IN (%s)
+            """ % (" ".join(["WHEN id = %s AND (materialized_until IS NULL OR materialized_until < %s) THEN %s"] * len(batch)),
+                   ", ".join(["%s"] * len(batch))), params + batch)
+
+        transaction.commit_unless_managed()
 
     @classmethod
-    def get_first(self, lst):
-        r = list(lst[:1])
-        
-        if r:
-            return r[0]
-        
-        return None
+    def rebase_timezone(self, user, old_tz_name, new_tz_name):
+        """
+        Moves the user's current and future instances from midnight in the
+        old timezone to midnight of the same local date in the new one,
+        keeping their completion and progress, then fills in whatever the
+        new timezone's occurrences are missing. Issues one UPDATE per
+        distinct (date, due_date) pair instead of several queries per goal.
+        """
+        old_tz, new_tz = pytz.timezone(old_tz_name), pytz.timezone(new_tz_name)
+        old_today = usercontext.local_midnight_utc(old_tz)
+
+        def rebase(dt):
+            if dt is None:
+                return None
+
+            naive = dt.astimezone(old_tz).replace(tzinfo=None)
+
+            return timezone.make_aware(naive, new_tz).astimezone(pytz.utc)
+
+        goals = list(Goal.objects.filter(user=user))
+        goal_ids = [goal.id for goal in goals]
+
+        current = ScheduledInstance.objects.filter(goal__in=goal_ids, date__gte=old_today)
+        pairs = sorted(set(current.values_list('date', 'due_date')))
+
+        if pairs and rebase(pairs[0][0]) > pairs[0][0]:
+            # moving rows later, so move the latest ones first to keep
+            # (goal, date) unique at every step
+            pairs.reverse()
+
+        for date, due_date in pairs:
+            current.filter(date=date, due_date=due_date).update(date=rebase(date), due_date=rebase(due_date))
+
+        Goal.objects.filter(id__in=goal_ids).update(materialized_until=None)
+
+        new_today = usercontext.local_midnight_utc(new_tz)
+        instances = []
+
+        for goal in goals:
+            goal.user = user
+            instances.extend(goal.scheduled_instances(new_today, 5))
+
+        cache.bump_data_version(user.id)
+
+        return ScheduledInstance.insert_missing(instances)
 
     @classmethod
-    def goals_for_today_by_type(self, user, completed):
+    def create_all_scheduled_instances(self, start, n, goals=None):
+        if goals is None:
+            goals = Goal.objects.all()
+
+        goals = goals.select_related('user__userprofile').order_by('id')
+
+        created, skipped = 0, 0
+        pending = []
+
+        for i, goal in enumerate(goals.iterator()):
+            pending.extend(goal.scheduled_instances(start, n))
+
+            if (i + 1) % self.INSERT_BATCH_GOALS == 0:
+                batch_created, batch_skipped = ScheduledInstance.insert_missing(pending)
+                created, skipped = created + batch_created, skipped + batch_skipped
+                pending = []
+
+        batch_created, batch_skipped = ScheduledInstance.insert_missing(pending)
+
+        return created + batch_created, skipped + batch_skipped
+
+    @classmethod
+    def instances_for_today(self, user):
+        """
+        Loads the user's goals and every instance covering today with one
+        query each. Returns a dict with the goals, the latest open ('todo')
+        and latest completed instance per goal, and all skipped instances.
+        Goals carry their stored streaks, which rebuildstreaks --rollover
+        keeps current across the end of each user's day.
+        """
+        today = Goal.beginning_today(user)
+
+        goals = list(Goal.objects.filter(user=user).order_by('id'))
+
+        current = ScheduledInstance.objects.filter(goal__user=user,
+                                                   date__lte=today,
+                                                   due_date__gt=today).order_by('goal', '-due_date')
+
+        by_goal = {}
+
+        for instance in current:
+            by_goal.setdefault(instance.goal_id, []).append(instance)
+
+        todo, completed, skipped = [], [], []
+
+        for goal in goals:
+            goal.user = user
+
+            instances = by_goal.get(goal.id, [])
+
+            for instance in instances:
+                instance.goal = goal
+
+            skipped.extend([i for i in instances if i.skipped])
+
+            latest_completed = next((i for i in instances if i.completed and not i.skipped), None)
+            latest_todo = next((i for i in instances if not i.completed and not i.skipped), None)
+
+            if latest_todo is None and not instances and Goal.virtual_instances_enabled():
+                latest_todo = goal.current_virtual_instance(today)
+
+            if latest_completed is not None:
+                completed.append(latest_completed)
+
+            if latest_todo is not None:
+                todo.append(latest_todo)
+
+        return {'goals': goals, 'todo': todo, 'completed': completed, 'skipped': skipped}
+
+    @classmethod
+    def cached_instances_for_today(self, user):
+        """
+        instances_for_today(user), cached until the user's goals or instances
+        change or their day ends when HABITS_DASHBOARD_CACHE_TIMEOUT is set.
+        """
+        timeout = getattr(settings, 'HABITS_DASHBOARD_CACHE_TIMEOUT', 0)
+
+        if not timeout:
+            return Goal.instances_for_today(user)
+
         today = Goal.beginning_today(user)
 
-        instances = [Goal.get_first(goal.scheduledinstance_set.filter(date__lte=today,
-                                                        due_date__gt=today,
-                                                    completed=completed,
-                                                    skipped=False).order_by('-due_date')) for
-                     goal in Goal.objects.filter(user=user)]
-        return [i for i in instances if i is not None]
+        return cache.cached_for_user(user.id, 'today', today.strftime("%Y%m%d%H%M"),
+                                     lambda: Goal.instances_for_today(user), timeout)
+
+    @classmethod
+    def skipped_goals_for_today(self, user):
+        return Goal.instances_for_today(user)['skipped']
+
+    @classmethod
+    def goals_for_today_by_type(self, user, completed):
+        return Goal.instances_for_today(user)['completed' if completed else 'todo']
 
     @classmethod
     def completed_goals_for_today(self, user):
@@ -295,7 +688,7 @@ class Goal(models.Model):
         return self.goals_for_today_by_type(user, False)
 
     def current_streak(self):
-        today = Goal.beginning_today(self.user)
+        today = self.today()
 
         previous_instances = self.past_instances()
 
@@ -311,35 +704,215 @@ class Goal(models.Model):
 
         return streak
 
+    def streaks_from_history(self):
+        """
+        Walks the goal's whole history once and returns the current and the
+        longest streak. Skipped instances neither count nor break a streak.
+        """
+        today = self.today()
+
+        run, longest = 0, 0
+
+        for instance in self.past_instances().reverse():
+            if instance.completed:
+                run += 1
+                longest = max(longest, run)
+            elif instance.skipped:
+                continue
+            elif instance.date < today:
+                run = 0
+
+        return run, longest
+
+    @classmethod
+    def refresh_streaks(self, goal_ids):
+        """
+        Recomputes the stored streak of each goal after its instances changed,
+        reading each batch of goals with one streaks_for() statement and
+        writing it with one UPDATE. Callers bump the owners' data versions
+        along with the instance changes.
+        """
+        goal_ids = sorted(set(goal_ids))
+        cursor = connection.cursor()
+
+        for i in xrange(0, len(goal_ids), self.UPDATE_BATCH_GOALS):
+            streaks = Goal.streaks_for(goal_ids=goal_ids[i:i + self.UPDATE_BATCH_GOALS]).items()
+
+            if not streaks:
+                continue
+
+            params = []
+
+            for goal_id, streak in streaks:
+                params.extend([goal_id, streak])
+
+            for goal_id, streak in streaks:
+                params.extend([goal_id, streak, streak])
+
+            params.extend([goal_id for goal_id, streak in streaks])
+
+            cursor.execute("""
+                UPDATE habits_goal
+                SET streak = CASE id %s END,
+                    longest_streak = CASE %s ELSE longest_streak END
+                WHERE id IN (%s)
+            """ % (" ".join(["WHEN %s THEN %s"] * len(streaks)),
+                   " ".join(["WHEN id = %s AND longest_streak < %s THEN %s"] * len(streaks)),
+                   ", ".join(["%s"] * len(streaks))), params)
+
+        transaction.commit_unless_managed()
+
+    STREAKS_SQL = """
+        SELECT g.id, COUNT(si.id)
+        FROM habits_goal g
+        INNER JOIN habits_userprofile p ON p.user_id = g.user_id
+        LEFT OUTER JOIN habits_scheduledinstance si
+            ON si.goal_id = g.id
+            AND si.completed = %%s
+            AND si.date <= %(today)s
+            AND NOT EXISTS (
+                SELECT 1 FROM habits_scheduledinstance missed
+                WHERE missed.goal_id = si.goal_id
+                AND missed.completed = %%s
+                AND missed.skipped = %%s
+                AND missed.date > si.date
+                AND missed.date < %(today)s)
+        %(where)s
+        GROUP BY g.id
+    """
+
+    @classmethod
+    def streaks_for(self, user=None, goal_ids=None):
+        """
+        current_streak() of every goal of user, or of every goal when user is
+        None, computed by the database in a single statement. goal_ids
+        narrows it down to those goals. A completed
+        instance counts towards the streak unless an instance that was
+        neither completed nor skipped comes after it and before today.
+        Returns a dict of goal id to streak.
+        """
+        ops = connection.ops
+
+        if user is not None:
+            today_sql = "%s"
+            today_params = [ops.value_to_db_datetime(Goal.beginning_today(user))]
+            where, where_params = "WHERE g.user_id = %s", [user.id]
+        else:
+            # today differs per timezone, so pick it per row
+            profiles = UserProfile.objects.all()
+
+            if goal_ids is not None:
+                profiles = profiles.filter(user__goal__in=goal_ids)
+
+            timezones = profiles.values_list('timezone', flat=True).distinct()
+            cases = dict((tz_name, usercontext.local_midnight_utc(pytz.timezone(tz_name))) for tz_name in timezones)
+
+            if not cases:
+                return {}
+
+            today_sql = "CASE p.timezone %s END" % " ".join(["WHEN %s THEN %s"] * len(cases))
+            today_params = []
+
+            for tz_name, today in cases.items():
+                today_params.extend([tz_name, ops.value_to_db_datetime(today)])
+
+            where, where_params = "WHERE 1 = 1", []
+
+        if goal_ids is not None:
+            if not goal_ids:
+                return {}
+
+            where += " AND g.id IN (%s)" % ", ".join(["%s"] * len(goal_ids))
+            where_params = where_params + list(goal_ids)
+
+        sql = self.STREAKS_SQL % {'today': today_sql, 'where': where}
+        params = [True] + today_params + [False, False] + today_params + where_params
+
+        cursor = connection.cursor()
+        cursor.execute(sql, params)
+
+        return dict(cursor.fetchall())
+
     def past_instances(self):
-        today = Goal.beginning_today(self.user)
+        today = self.today()
 
         return self.scheduledinstance_set.filter(date__lte=today).order_by('-date')
 
+    # how many past due instances per goal the streaks page shows
+    MISSED_INSTANCES = 7
+
+    # earlier than any due date, for goals with fewer instances than that
+    EPOCH = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+
     def missed_instances(self):
-        today = Goal.beginning_today(self.user)
+        """
+        The goal's last 7 due instances. Cached on the goal, and preloaded in
+        bulk for every goal by with_missed_instances().
+        """
+        if getattr(self, '_missed_instances_cache', None) is None:
+            today = self.today()
+
+            # last 7 instances of the goal
+            self._missed_instances_cache = list(self.scheduledinstance_set.filter(
+                due_date__lte=today).order_by('-due_date')[:self.MISSED_INSTANCES])
 
-        # last 7 instances of the goal
-        return self.scheduledinstance_set.filter(due_date__lte=today).order_by('-due_date')[:7]
+        return self._missed_instances_cache
 
     @classmethod
-    def past_instances_by_day(self, user):
-        user_goals = Goal.objects.filter(user=user).select_related('scheduledinstances')
-        missed_instances = [goal.missed_instances() for goal in user_goals] 
-        flattened = list(itertools.chain.from_iterable(missed_instances))
+    def with_missed_instances(self, user):
+        """
+        The user's goals with missed_instances() already filled in, plus the
+        flat list of those instances, using two queries in total.
+        """
+        goals = list(Goal.objects.filter(user=user).order_by('id'))
+        by_goal = dict((goal.id, goal) for goal in goals)
 
-        by_date = {}
+        for goal in goals:
+            goal.user = user
+            goal._missed_instances_cache = []
 
-        for i in flattened:
-            if not by_date.get(i.due_date, None):
-                by_date[i.due_date] = []
+        instances = list(Goal.recent_due_instances(user))
 
-            by_date[i.due_date].append(i)
+        for instance in instances:
+            instance.goal = by_goal[instance.goal_id]
+            instance.goal._missed_instances_cache.append(instance)
 
-        od = list(OrderedDict(sorted(by_date.items())).iteritems())
+        return goals, instances
+
+    @classmethod
+    def recent_due_instances(self, user):
+        """
+        The last MISSED_INSTANCES instances per goal of the user that are due
+        by today, with their goal, in one query. Each goal's instances are
+        read from its MISSED_INSTANCES-th latest due date on, which the
+        (goal, due_date) index finds without reading older history.
+        """
+        today = Goal.beginning_today(user)
+        ops = connection.ops
+
+        return ScheduledInstance.objects.filter(goal__user=user, due_date__lte=today).extra(
+            where=["""habits_scheduledinstance.due_date >= COALESCE(
+                          (SELECT cutoff.due_date FROM habits_scheduledinstance cutoff
+                           WHERE cutoff.goal_id = habits_goal.id
+                           AND cutoff.due_date <= %s
+                           ORDER BY cutoff.due_date DESC
+                           LIMIT 1 OFFSET %s), %s)"""],
+            params=[ops.value_to_db_datetime(today), self.MISSED_INSTANCES - 1,
+                    ops.value_to_db_datetime(self.EPOCH)]
+        ).select_related('goal').order_by('goal', '-due_date')
+
+    @classmethod
+    def past_instances_by_day(self, user, instances=None):
+        if instances is None:
+            instances = Goal.recent_due_instances(user)
+
+        by_date = {}
+
+        for i in instances:
+            by_date.setdefault(i.due_date, []).append(i)
+
+        return sorted(by_date.items(), reverse=True)
 
-        od.reverse()
-        return od
     def day_string(self):
         unit_types = {"daily": "day",
                       "weekly": "week",
@@ -403,6 +976,116 @@ class Goal(models.Model):
                             "goal_amount=" + str(self.goal_amount)]
                         )
 
+def remember_goal_rrule(sender, instance, **kwargs):
+    instance._loaded_rrule = instance.rrule
+
+def invalidate_goal_rrule(sender, instance, **kwargs):
+    old_rrule = getattr(instance, '_loaded_rrule', None)
+
+    if old_rrule and old_rrule != instance.rrule:
+        rrule_cache.invalidate(lambda key: key[0] == old_rrule)
+
+    instance._loaded_rrule = instance.rrule
+
+post_init.connect(remember_goal_rrule, sender=Goal)
+post_save.connect(invalidate_goal_rrule, sender=Goal)
+
+# ids of the goals this thread is deleting; their instances are deleted
+# along with them, and each goal bumps its owner once instead of per instance
+_deleting = threading.local()
+
+def deleting_goal_ids():
+    if not hasattr(_deleting, 'goal_ids'):
+        _deleting.goal_ids = set()
+
+    return _deleting.goal_ids
+
+def remember_deleting_goal(sender, instance, **kwargs):
+    deleting_goal_ids().add(instance.pk)
+
+def bump_goal_owner(sender, instance, **kwargs):
+    cache.bump_data_version(instance.user_id)
+
+def bump_deleted_goal_owner(sender, instance, **kwargs):
+    deleting_goal_ids().discard(instance.pk)
+    cache.bump_data_version(instance.user_id)
+
+pre_delete.connect(remember_deleting_goal, sender=Goal)
+post_save.connect(bump_goal_owner, sender=Goal)
+post_delete.connect(bump_deleted_goal_owner, sender=Goal)
+
+class VirtualInstance(object):
+    """
+    An occurrence of a goal computed from its rrule that has no row in the
+    database yet. Looks like an untouched ScheduledInstance to templates and
+    views; materialize() writes the row once the user acts on it.
+    """
+    PREFIX = 'v'
+
+    completed = False
+    skipped = False
+    current_progress = 0
+
+    def __init__(self, goal, date, due_date):
+        self.goal = goal
+        self.goal_id = goal.id
+        self.date = date
+        self.due_date = due_date
+
+    @property
+    def id(self):
+        return "%s%d-%d" % (self.PREFIX, self.goal_id, calendar.timegm(self.date.utctimetuple()))
+
+    pk = id
+
+    @classmethod
+    def is_virtual_id(self, instance_id):
+        return str(instance_id).startswith(self.PREFIX)
+
+    @classmethod
+    def from_id(self, instance_id, user):
+        """
+        Rebuilds a virtual instance from its id, raising
+        ScheduledInstance.DoesNotExist if the id doesn't name an occurrence
+        of one of user's goals.
+        """
+        try:
+            goal_id, timestamp = [int(part) for part in instance_id[len(self.PREFIX):].split('-')]
+        except ValueError:
+            raise ScheduledInstance.DoesNotExist("Malformed instance id %s" % instance_id)
+
+        try:
+            goal = Goal.objects.get(pk=goal_id, user=user)
+        except Goal.DoesNotExist:
+            raise ScheduledInstance.DoesNotExist("No goal for instance id %s" % instance_id)
+
+        date = datetime.datetime.utcfromtimestamp(timestamp).replace(tzinfo=pytz.utc)
+
+        occurrence = next(goal.occurrences(date), None)
+
+        if occurrence is None or occurrence[0] != date:
+            raise ScheduledInstance.DoesNotExist("%s is not an occurrence of its goal" % instance_id)
+
+        return VirtualInstance(goal, *occurrence)
+
+    def materialize(self):
+        instance, created = ScheduledInstance.objects.get_or_create(goal=self.goal, date=self.date,
+                                                                    defaults={'due_date': self.due_date})
+        return instance
+
+    def __eq__(self, other):
+        return isinstance(other, VirtualInstance) and \
+               (self.goal_id, self.date) == (other.goal_id, other.date)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __unicode__(self):
+        return ", ".join(["goal = " + self.goal.creation_text,
+                          "date = " + str(self.date),
+                          "due_date = " + str(self.due_date),
+                          "virtual = True"])
+
 class ScheduledInstance(models.Model):
     goal = models.ForeignKey(Goal)
     date = models.DateTimeField(db_index=True)
@@ -411,13 +1094,255 @@ class ScheduledInstance(models.Model):
     current_progress = models.IntegerField(default=0)
     skipped = models.BooleanField(db_index=True, default=False)
 
+    # instances whose due date is rewritten per UPDATE; at three parameters
+    # each this stays under sqlite's limit of 999
+    UPDATE_BATCH_ROWS = 300
+
     def compute_due_date(self):
-        if ("BYDAY=" in self.goal.rrule and "FREQ=WEEKLY" in self.goal.rrule) or \
-        ("BYMONTHDAY=" in self.goal.rrule and "FREQ=MONTHLY" in self.goal.rrule):
-            return self.date + datetime.timedelta(days=1)
+        """
+        Due date of this instance. Every other instance of the goal that has
+        no due date yet is computed along with it, from the same expansion
+        of the rule, so asking each of them in turn expands it once.
+        """
+        goal = self.goal
+        tz_name = goal.tz_name()
+
+        def compute():
+            instances = [self]
+
+            if goal.pk is not None:
+                instances.extend(goal.scheduledinstance_set.filter(due_date__isnull=True).exclude(date=self.date))
+
+            due_dates = ScheduledInstance.compute_due_dates(goal, instances)
+            due_date_cache.update(((goal.rrule, tz_name, instance.date), due_date)
+                                  for instance, due_date in zip(instances, due_dates))
+
+            return due_dates[0]
+
+        return due_date_cache.get((goal.rrule, tz_name, self.date), compute)
+
+    @classmethod
+    def compute_due_dates(self, goal, instances):
+        """
+        Due dates of several instances of goal, in the order given, from a
+        single expansion of the goal's rule: each instance is due at the
+        first occurrence after it.
+        """
+        if goal.due_next_day():
+            return [instance.date + datetime.timedelta(days=1) for instance in instances]
+
+        if not instances:
+            return []
+
+        dates = sorted(set(instance.date for instance in instances))
+        occurrences = (date for date, due_date in goal.occurrences(dates[0]))
+
+        due_dates = {}
+        occurrence = next(occurrences, None)
+
+        for date in dates:
+            while occurrence is not None and occurrence <= date:
+                occurrence = next(occurrences, None)
+
+            due_dates[date] = occurrence
+
+        return [due_dates[instance.date] for instance in instances]
+
+    @classmethod
+    def repair_due_dates(self, goals=None):
+        """
+        Fills in every missing due_date, computing them per goal with
+        compute_due_dates and writing them with one UPDATE per batch of rows.
+        Returns the number of instances repaired.
+        """
+        missing = ScheduledInstance.objects.filter(due_date__isnull=True)
+
+        if goals is not None:
+            missing = missing.filter(goal__in=goals)
 
-        return self.goal.next_date(self.date)
+        by_goal = {}
+
+        for instance in missing.select_related('goal__user__userprofile').order_by('goal', 'date'):
+            by_goal.setdefault(instance.goal_id, []).append(instance)
+
+        rows = []
+
+        for instances in by_goal.values():
+            due_dates = ScheduledInstance.compute_due_dates(instances[0].goal, instances)
+            rows.extend((instance.id, due_date) for instance, due_date in zip(instances, due_dates)
+                        if due_date is not None)
+
+        cursor = connection.cursor()
+
+        for i in xrange(0, len(rows), self.UPDATE_BATCH_ROWS):
+            batch = rows[i:i + self.UPDATE_BATCH_ROWS]
+            params = []
+
+            for instance_id, due_date in batch:
+                params.extend([instance_id, connection.ops.value_to_db_datetime(due_date)])
+
+            params.extend([instance_id for instance_id, due_date in batch])
+
+            cursor.execute("""
+                UPDATE habits_scheduledinstance
+                SET due_date = CASE id %s END
+                WHERE id IN (%s)
+            """ % (" ".join(["WHEN %s THEN %s"] * len(batch)), ", ".join(["%s"] * len(batch))), params)
+
+        transaction.commit_unless_managed()
+
+        return len(rows)
     
+    @classmethod
+    def insert_missing(self, instances):
+        """
+        Inserts the instances whose (goal, date) pair doesn't exist yet. The
+        existing pairs are loaded with one query and the rest go in with one
+        bulk insert. Returns a (created, skipped) tuple.
+        """
+        if not instances:
+            return 0, 0
+
+        goal_ids = set(instance.goal_id for instance in instances)
+        dates = [instance.date for instance in instances]
+
+        seen = set(ScheduledInstance.objects.filter(goal__in=goal_ids,
+                                                    date__gte=min(dates),
+                                                    date__lte=max(dates)).values_list('goal', 'date'))
+
+        Goal.advance_watermarks(instances)
+
+        missing = []
+
+        for instance in instances:
+            key = (instance.goal_id, instance.date)
+
+            if key not in seen:
+                seen.add(key)
+                missing.append(instance)
+
+        sid = transaction.savepoint()
+
+        try:
+            ScheduledInstance.objects.bulk_create(missing)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # lost a race with another writer; settle it row by row without
+            # aborting the surrounding transaction
+            transaction.savepoint_rollback(sid)
+
+            created = 0
+
+            for instance in missing:
+                sid = transaction.savepoint()
+
+                try:
+                    instance.save()
+                    transaction.savepoint_commit(sid)
+                    created += 1
+                except IntegrityError:
+                    transaction.savepoint_rollback(sid)
+
+            return created, len(instances) - created
+
+        cache.bump_data_version(*set(instance.goal.user_id for instance in missing))
+
+        return len(missing), len(instances) - len(missing)
+
+    @classmethod
+    def resolve(self, instance_id, user):
+        """
+        Loads user's instance with the given id, writing the row first if the
+        id belongs to a virtual instance. Raises DoesNotExist for instances
+        of other users' goals.
+        """
+        if VirtualInstance.is_virtual_id(instance_id):
+            return VirtualInstance.from_id(instance_id, user).materialize()
+
+        return ScheduledInstance.objects.get(pk=instance_id, goal__user=user)
+
+    @classmethod
+    def complete_many(self, instance_ids, user):
+        """
+        Records one unit of progress on each of the user's instances named in
+        instance_ids. Progress is incremented in the database rather than
+        read, modified and saved, so concurrent requests can't lose updates.
+        Meant to run inside the caller's transaction. Returns the ids of the
+        goals that were touched.
+        """
+        ids = []
+
+        for instance_id in instance_ids:
+            if not VirtualInstance.is_virtual_id(instance_id):
+                ids.append(int(instance_id))
+                continue
+
+            # only occurrences of the user's own goals are written
+            try:
+                ids.append(ScheduledInstance.resolve(instance_id, user).id)
+            except ScheduledInstance.DoesNotExist:
+                pass
+
+        owned = ScheduledInstance.objects.filter(id__in=ids, goal__user=user)
+
+        rows = list(owned.values_list('id', 'goal'))
+        owned_ids = [row[0] for row in rows]
+        goal_ids = list(set(row[1] for row in rows))
+
+        owned.filter(goal__incremental=False).update(completed=True)
+        owned.filter(goal__incremental=True, completed=False).update(current_progress=F('current_progress') + 1)
+
+        if owned_ids:
+            cursor = connection.cursor()
+            cursor.execute("""
+                UPDATE habits_scheduledinstance SET completed = %%s
+                WHERE id IN (%s) AND completed = %%s
+                AND current_progress >= (SELECT goal_amount FROM habits_goal
+                                         WHERE habits_goal.id = habits_scheduledinstance.goal_id
+                                         AND habits_goal.incremental = %%s)
+            """ % ", ".join(["%s"] * len(owned_ids)), [True] + owned_ids + [False, True])
+
+            transaction.commit_unless_managed()
+
+            cache.bump_data_version(user.id)
+
+        return goal_ids
+
+    @classmethod
+    def mark_complete(self, instance_ids, user):
+        """
+        Marks the user's instances in instance_ids completed, filling
+        incremental ones up to their goal's goal_amount. Takes the same
+        number of statements however many instances are posted. Returns the
+        ids of the goals that were touched.
+        """
+        owned = ScheduledInstance.objects.filter(id__in=instance_ids, goal__user=user)
+
+        rows = list(owned.values_list('id', 'goal'))
+        owned_ids = [row[0] for row in rows]
+        goal_ids = list(set(row[1] for row in rows))
+
+        if not owned_ids:
+            return goal_ids
+
+        owned.filter(goal__incremental=False).update(completed=True)
+
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE habits_scheduledinstance
+            SET completed = %%s,
+                current_progress = (SELECT goal_amount FROM habits_goal
+                                    WHERE habits_goal.id = habits_scheduledinstance.goal_id)
+            WHERE id IN (%s)
+            AND goal_id IN (SELECT id FROM habits_goal WHERE incremental = %%s)
+        """ % ", ".join(["%s"] * len(owned_ids)), [True] + owned_ids + [True])
+
+        transaction.commit_unless_managed()
+
+        cache.bump_data_version(user.id)
+
+        return goal_ids
+
     def progress(self):
         if self.goal.incremental:
             self.current_progress += 1
@@ -436,5 +1361,36 @@ class ScheduledInstance(models.Model):
                           "skipped = " + str(self.skipped)],
                           )
 
+    def owner_id(self):
+        """
+        Id of the user the instance belongs to, looked up only when its goal
+        isn't loaded yet.
+        """
+        goal = self.__dict__.get('_goal_cache')
+
+        if goal is not None:
+            return goal.user_id
+
+        owners = list(Goal.objects.filter(pk=self.goal_id).values_list('user', flat=True))
+
+        return owners[0] if owners else None
+
     class Meta:
+        # migration 0018 also adds (goal, due_date, completed, skipped) for
+        # the dashboard and (goal, completed, skipped, date) for streaks,
+        # which this version of Django can't declare here
         unique_together = (("goal", "date"),)
+
+def bump_instance_owner(sender, instance, **kwargs):
+    # instances deleted along with their goal are covered by the goal's bump
+    if instance.goal_id in deleting_goal_ids():
+        return
+
+    user_id = instance.owner_id()
+
+    if user_id is not None:
+        cache.bump_data_version(user_id)
+
+post_save.connect(bump_instance_owner, sender=ScheduledInstance)
+post_delete.connect(bump_instance_owner, sender=ScheduledInstance)
+
@@ -0,0 +1,94 @@
+"""
+Records the SQL a block of code sends to the database, with parameters and
+timings, without needing DEBUG on and without filling connection.queries.
+"""
+
+import time
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.backends import util
+
+class RecordingCursor(object):
+    def __init__(self, cursor, recorder):
+        self.cursor = cursor
+        self.recorder = recorder
+
+    def execute(self, sql, params=()):
+        started = time.time()
+
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.recorder.record(sql, params, time.time() - started)
+
+    def executemany(self, sql, param_list):
+        started = time.time()
+
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.recorder.record(sql, None, time.time() - started)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+class QueryRecorder(object):
+    """
+    Context manager collecting every statement executed on a connection
+    while it is active as dicts with 'sql', 'params' and 'time'
+    (seconds). Recorders can be nested; statements are recorded by all of
+    them, and connection.queries keeps working when DEBUG is on.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.connection = connections[using]
+        self.queries = []
+
+    def record(self, sql, params, elapsed):
+        self.queries.append({'sql': sql, 'params': params, 'time': elapsed})
+
+    def __enter__(self):
+        self.queries = []
+
+        connection = self.connection
+
+        self.previous_use_debug_cursor = connection.use_debug_cursor
+        self.previous_make_debug_cursor = connection.__dict__.get('make_debug_cursor')
+
+        if self.previous_use_debug_cursor or (self.previous_use_debug_cursor is None and settings.DEBUG):
+            wrap = connection.make_debug_cursor
+        else:
+            wrap = lambda cursor: util.CursorWrapper(cursor, connection)
+
+        connection.make_debug_cursor = lambda cursor: RecordingCursor(wrap(cursor), self)
+        connection.use_debug_cursor = True
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        connection = self.connection
+
+        connection.use_debug_cursor = self.previous_use_debug_cursor
+
+        if self.previous_make_debug_cursor is None:
+            del connection.make_debug_cursor
+        else:
+            connection.make_debug_cursor = self.previous_make_debug_cursor
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self):
+        return sum(query['time'] for query in self.queries)
+
+    def slowest(self):
+        if not self.queries:
+            return None
+
+        return max(self.queries, key=lambda query: query['time'])
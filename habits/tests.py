@@ -1,10 +1,22 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.db import connection
+from django.utils.unittest import skipIf
+from django.core.management import call_command
+from django.test.utils import override_settings
 from django.db import IntegrityError
 from django.utils import timezone
+from django.core.urlresolvers import resolve, Resolver404
+from django.http import Http404
+from django.test.client import RequestFactory
 
-from habits.models import Goal, InvalidInput, ScheduledInstance, UserProfile
+from habits.models import Goal, InvalidInput, ScheduledInstance, UserProfile, VirtualInstance, rrule_cache, parse_cache, due_date_cache, deleting_goal_ids
+from habits.management.commands.geninstances import id_ranges
+from habits import usercontext, views
 from django.contrib.auth.models import User
 import datetime
+import itertools
+import json
+import threading
 import pytz
 
 class GoalTest(TestCase):
@@ -33,6 +45,7 @@ class GoalTest(TestCase):
 
         self.five_days_ago = self.today - datetime.timedelta(days=5)
         self.four_days_ago = self.today - datetime.timedelta(days=4)
+        self.two_days_ago = self.today - datetime.timedelta(days=2)
 
         self.old_goal = Goal()
         self.old_goal.user = self.user
@@ -164,6 +177,30 @@ class GoalTest(TestCase):
 
         self.assertRaises(InvalidInput, goal.parse, "Go to the doctor once a decade")
 
+    def test_parse_cache(self):
+        parse_cache.clear()
+
+        for text in ["Walk every day", "Run  every DAY", "Swim every day"]:
+            goal = Goal()
+            goal.user = self.user
+            goal.parse(text)
+
+            self.assertEqual(goal.rrule, self.simple_goal.rrule)
+
+        self.assertEquals(parse_cache.stats()['misses'], 1)
+        self.assertEquals(parse_cache.stats()['hits'], 2)
+
+        goal = Goal()
+        goal.user = self.user
+        self.assertRaises(InvalidInput, goal.parse, "Do something every hour")
+        self.assertRaises(InvalidInput, goal.parse, "Do something every hour")
+        self.assertEquals(parse_cache.stats()['hits'], 3)
+
+        # relative start dates are cached per day
+        params, rrule = Goal.parse_recurrence("every day starting tomorrow", self.today)
+        self.assertEquals(Goal.parse_recurrence("every day starting tomorrow", self.tomorrow), (params, rrule))
+        self.assertEquals(parse_cache.stats()['misses'], 4)
+
     def test_splitting_input(self):
 
         goal = Goal()
@@ -193,6 +230,47 @@ class GoalTest(TestCase):
         self.assertEqual(self.byday_goal.generate_next_scheduled_instances(datetime.datetime(2013, 1, 9, 8).replace(tzinfo=pytz.utc), 3),
             [datetime.datetime(2013, 1, 9, 8).replace(tzinfo=pytz.utc), datetime.datetime(2013, 1, 11, 8).replace(tzinfo=pytz.utc), datetime.datetime(2013, 1, 14, 8).replace(tzinfo=pytz.utc)])
 
+    def test_compiled_rrule_cache(self):
+        rrule_cache.clear()
+
+        self.simple_goal.next_date(self.today)
+        self.simple_goal.next_date(self.tomorrow)
+
+        self.assertEquals(rrule_cache.stats()['misses'], 1)
+        self.assertEquals(rrule_cache.stats()['hits'], 1)
+
+        old_rrule = self.simple_goal.rrule
+        self.simple_goal.rrule = 'DTSTART:' + self.today.strftime("%Y%m%d") + '\nRRULE:FREQ=DAILY;INTERVAL=2'
+        self.simple_goal.save()
+
+        self.assertFalse([key for key in rrule_cache._data.keys() if key[0] == old_rrule])
+        self.assertEquals(self.simple_goal.next_date(self.today), self.day_after_tomorrow)
+
+    def test_occurrences_match_due_dates(self):
+        for goal in [self.simple_goal, self.byday_goal, self.old_goal]:
+            for date, due_date in itertools.islice(goal.occurrences(self.five_days_ago), 5):
+                instance = ScheduledInstance(goal=goal, date=date)
+
+                self.assertEquals(due_date, instance.compute_due_date())
+
+    def test_user_context(self):
+        goal = Goal.objects.get(pk=self.simple_goal.pk)
+
+        usercontext.activate(self.user.id, self.user.userprofile.timezone)
+
+        try:
+            with self.assertNumQueries(0):
+                self.assertEquals(goal.today(), self.today)
+                self.assertEquals(goal.next_date(self.today), self.tomorrow)
+
+            profile = self.user.userprofile
+            profile.timezone = 'Europe/London'
+            profile.save()
+
+            self.assertEquals(Goal.user_tz(self.user).zone, 'Europe/London')
+        finally:
+            usercontext.deactivate()
+
     def test_generating_all_scheduled_instances(self):
         """
         Tests generating scheduled instances for all goals.
@@ -216,6 +294,32 @@ class GoalTest(TestCase):
         # one for the newer goal already exists
         self.assertEquals(ScheduledInstance.objects.count(), 11)
 
+    def test_geninstances_shards(self):
+        self.assertEquals(id_ranges([1, 2, 3, 5, 8], 2), [(1, 3), (5, 8)])
+        self.assertEquals(id_ranges([1, 2], 4), [(1, 1), (2, 2)])
+
+        call_command('geninstances', shard='0/2')
+        call_command('geninstances', shard='1/2')
+
+        for goal in Goal.objects.all():
+            self.assertEquals(goal.scheduledinstance_set.count(), 5)
+
+    def test_materialization_watermark(self):
+        self.simple_goal.create_scheduled_instances(self.today, 5)
+
+        simple_goal = Goal.objects.get(pk=self.simple_goal.pk)
+        self.assertEquals(simple_goal.materialized_until, self.today + datetime.timedelta(days=4))
+
+        horizon_end = self.today + datetime.timedelta(days=2)
+        self.assertEquals(set(Goal.needing_instances(horizon_end)), set([self.byday_goal, self.old_goal]))
+
+        call_command('geninstances')
+
+        self.assertEquals(list(Goal.needing_instances(horizon_end)), [])
+
+        # the simple goal already had its instances and was left alone
+        self.assertEquals(self.simple_goal.scheduledinstance_set.count(), 5)
+
     def test_getting_todays_goals(self):
         self.byday_goal.delete()
         self.old_goal.delete()
@@ -233,6 +337,30 @@ class GoalTest(TestCase):
 
         self.assertEquals(Goal.goals_for_today(self.user), [])
 
+    def test_todays_instances_in_one_query(self):
+        Goal.create_all_scheduled_instances(self.five_days_ago, 10)
+
+        skipped = self.old_goal.scheduledinstance_set.get(date=self.today)
+        skipped.skipped = True
+        skipped.save()
+
+        done = self.simple_goal.scheduledinstance_set.get(date=self.today)
+        done.completed = True
+        done.save()
+
+        usercontext.activate(self.user.id, self.user.userprofile.timezone)
+
+        try:
+            with self.assertNumQueries(2):
+                today = Goal.instances_for_today(self.user)
+        finally:
+            usercontext.deactivate()
+
+        self.assertEquals(today['completed'], [done])
+        self.assertEquals(today['skipped'], [skipped])
+        self.assertEquals(today['todo'], list(self.byday_goal.scheduledinstance_set.filter(date=self.today)))
+        self.assertEquals(today['goals'], [self.simple_goal, self.byday_goal, self.old_goal])
+
     def test_getting_todays_old_goals(self):
         self.old_goal.rrule = 'DTSTART:' + self.old_goal.dtstart.strftime("%Y%m%d") + '\nRRULE:FREQ=WEEKLY;INTERVAL=1'
         self.old_goal.save()
@@ -244,6 +372,88 @@ class GoalTest(TestCase):
 
         self.assertEquals(Goal.goals_for_today(self.user), [instance])
 
+    @override_settings(HABITS_VIRTUAL_INSTANCES=True)
+    def test_virtual_instances(self):
+        self.byday_goal.delete()
+        self.old_goal.delete()
+
+        self.simple_goal.create_scheduled_instances(self.tomorrow, 5)
+        self.assertEquals(ScheduledInstance.objects.count(), 0)
+
+        virtual = Goal.goals_for_today(self.user)[0]
+
+        self.assertTrue(isinstance(virtual, VirtualInstance))
+        self.assertEquals(virtual.date, self.today)
+        self.assertEquals(virtual.due_date, self.tomorrow)
+        self.assertEquals(VirtualInstance.from_id(virtual.id, self.user), virtual)
+
+        other = User.objects.create(username="bar")
+        self.assertRaises(ScheduledInstance.DoesNotExist, ScheduledInstance.resolve, virtual.id, other)
+        self.assertEquals(ScheduledInstance.objects.count(), 0)
+
+        instance = ScheduledInstance.resolve(virtual.id, self.user)
+        instance.progress()
+        instance.save()
+
+        self.assertEquals(Goal.goals_for_today(self.user), [])
+        self.assertEquals(Goal.completed_goals_for_today(self.user), [instance])
+
+        bad_id = "v%d-%d" % (self.simple_goal.id, 12345)
+        self.assertRaises(ScheduledInstance.DoesNotExist, ScheduledInstance.resolve, bad_id, self.user)
+
+    def test_rebase_timezone(self):
+        self.byday_goal.delete()
+
+        Goal.create_all_scheduled_instances(self.today, 5)
+        self.simple_goal.scheduledinstance_set.filter(date=self.today).update(completed=True)
+        self.old_goal.scheduledinstance_set.filter(date=self.tomorrow).update(current_progress=2)
+
+        local_dates = set(ScheduledInstance.objects.values_list('date', flat=True))
+        local_dates = set(d.astimezone(pytz.timezone('America/Los_Angeles')).date() for d in local_dates)
+
+        profile = self.user.userprofile
+        profile.timezone = 'Asia/Tokyo'
+        profile.save()
+
+        Goal.rebase_timezone(self.user, 'America/Los_Angeles', 'Asia/Tokyo')
+
+        tokyo = pytz.timezone('Asia/Tokyo')
+
+        for instance in ScheduledInstance.objects.all():
+            local = instance.date.astimezone(tokyo)
+            self.assertEquals((local.hour, local.minute), (0, 0))
+            self.assertEquals(instance.due_date, instance.date + datetime.timedelta(days=1))
+
+        rebased = ScheduledInstance.objects.filter(date__lte=Goal.beginning_today(self.user) + datetime.timedelta(days=4))
+        self.assertTrue(local_dates <= set(i.date.astimezone(tokyo).date() for i in rebased))
+
+        done = self.simple_goal.scheduledinstance_set.get(completed=True)
+        self.assertEquals(done.date.astimezone(tokyo).date(), self.today.astimezone(pytz.timezone('America/Los_Angeles')).date())
+
+        progressed = self.old_goal.scheduledinstance_set.get(current_progress=2)
+        self.assertEquals(progressed.date.astimezone(tokyo).date(), self.tomorrow.astimezone(pytz.timezone('America/Los_Angeles')).date())
+
+    def test_importgoals_rebases_existing_users(self):
+        import tempfile
+
+        self.byday_goal.delete()
+        Goal.create_all_scheduled_instances(self.today, 5)
+
+        with tempfile.NamedTemporaryFile(suffix='.csv') as source:
+            source.write("foo,Asia/Tokyo,Stretch every day\n")
+            source.flush()
+
+            call_command('importgoals', source.name)
+
+        self.assertEquals(UserProfile.objects.get(user=self.user).timezone, 'Asia/Tokyo')
+        self.assertEquals(Goal.objects.filter(user=self.user).count(), 3)
+
+        tokyo = pytz.timezone('Asia/Tokyo')
+
+        for instance in ScheduledInstance.objects.all():
+            local = instance.date.astimezone(tokyo)
+            self.assertEquals((local.hour, local.minute), (0, 0))
+
     def test_streak_calculation(self):
         self.old_goal.rrule = 'DTSTART:' + self.old_goal.dtstart.strftime("%Y%m%d") + '\nRRULE:FREQ=DAILY;INTERVAL=1'
         self.old_goal.save()
@@ -288,6 +498,121 @@ class GoalTest(TestCase):
 
         self.assertEquals(self.old_goal.current_streak(), 4)
 
+    def assertStreaksMatch(self):
+        streaks = Goal.streaks_for(self.user)
+
+        for goal in Goal.objects.filter(user=self.user):
+            self.assertEquals(streaks[goal.id], goal.current_streak())
+
+        all_streaks = Goal.streaks_for()
+
+        for goal in Goal.objects.all():
+            self.assertEquals(all_streaks[goal.id], goal.current_streak())
+
+    def test_streaks_in_one_query(self):
+        intl_user = User(username="intlfoo", password="blah1234")
+        intl_user.save()
+        intl_user.userprofile.timezone = 'Asia/Tokyo'
+        intl_user.userprofile.save()
+
+        intl_goal = Goal()
+        intl_goal.user = intl_user
+        intl_goal.parse("Do a thing every day")
+        intl_goal.save()
+        intl_goal.create_scheduled_instances(Goal.beginning_today(intl_user), 1)
+        intl_goal.scheduledinstance_set.update(completed=True)
+
+        self.old_goal.create_scheduled_instances(self.five_days_ago, 10)
+        self.simple_goal.create_scheduled_instances(self.today, 3)
+        self.assertStreaksMatch()
+
+        self.old_goal.scheduledinstance_set.filter(date__lt=self.today).update(completed=True)
+        self.assertStreaksMatch()
+
+        self.old_goal.scheduledinstance_set.filter(date=self.four_days_ago).update(completed=False, skipped=True)
+        self.assertStreaksMatch()
+
+        self.old_goal.scheduledinstance_set.filter(date=self.yesterday).update(completed=False)
+        self.assertStreaksMatch()
+
+        self.old_goal.scheduledinstance_set.filter(date=self.today).update(completed=True)
+        self.assertStreaksMatch()
+        self.assertEquals(Goal.streaks_for(self.user)[self.old_goal.id], 1)
+
+    def test_stored_streaks(self):
+        self.byday_goal.delete()
+
+        self.old_goal.create_scheduled_instances(self.five_days_ago, 10)
+        self.old_goal.scheduledinstance_set.filter(date__lt=self.today).update(completed=True)
+        self.old_goal.scheduledinstance_set.filter(date=self.yesterday).update(completed=False)
+
+        Goal.refresh_streaks([self.old_goal.id])
+
+        old_goal = Goal.objects.get(pk=self.old_goal.pk)
+        self.assertEquals((old_goal.streak, old_goal.longest_streak), (0, 0))
+        self.assertEquals(old_goal.streaks_from_history(), (0, 4))
+
+        call_command('rebuildstreaks')
+
+        old_goal = Goal.objects.get(pk=self.old_goal.pk)
+        self.assertEquals((old_goal.streak, old_goal.longest_streak), (0, 4))
+
+        self.old_goal.scheduledinstance_set.filter(date=self.yesterday).update(completed=True)
+
+        self.assertRaises(SystemExit, call_command, 'rebuildstreaks', check=True)
+
+        Goal.refresh_streaks([self.old_goal.id])
+
+        self.old_goal.scheduledinstance_set.filter(date=self.two_days_ago).update(completed=False)
+        call_command('rebuildstreaks', rollover=True)
+        call_command('rebuildstreaks', check=True)
+
+        self.old_goal.scheduledinstance_set.filter(date=self.two_days_ago).update(completed=True)
+        Goal.refresh_streaks([self.old_goal.id])
+
+        old_goal = Goal.objects.get(pk=self.old_goal.pk)
+        self.assertEquals((old_goal.streak, old_goal.longest_streak), (5, 5))
+
+        call_command('rebuildstreaks', check=True)
+
+        # timezones, streaks and one UPDATE however many goals changed
+        with self.assertNumQueries(3):
+            Goal.refresh_streaks([self.old_goal.id, self.simple_goal.id])
+
+        self.assertEquals(Goal.objects.get(pk=self.old_goal.pk).longest_streak, 5)
+
+    def test_past_instances_by_day(self):
+        Goal.create_all_scheduled_instances(self.today - datetime.timedelta(days=30), 40)
+
+        expected = {}
+
+        for goal in Goal.objects.filter(user=self.user):
+            for instance in goal.missed_instances():
+                expected.setdefault(instance.due_date, set()).add(instance)
+
+        with self.assertNumQueries(1):
+            by_day = Goal.past_instances_by_day(self.user)
+            descriptions = [i.goal.description for date, instances in by_day for i in instances]
+
+        self.assertEquals([date for date, instances in by_day], sorted(expected.keys(), reverse=True))
+        self.assertEquals(dict((date, set(instances)) for date, instances in by_day), expected)
+        self.assertEquals(len(descriptions), sum(len(instances) for instances in expected.values()))
+
+    def test_import_goals(self):
+        goals, errors = Goal.import_goals(self.user, [(1, "Read every day"),
+                                                      (2, "Herp a derp on Monday"),
+                                                      (3, "Read every day"),
+                                                      (4, "Stretch every weekday"),
+                                                      (5, "Read %s every day" % ("a" * 200))])
+
+        self.assertEquals([goal.creation_text for goal in goals], ["Read every day", "Read every day", "Stretch every weekday"])
+        self.assertEquals(len(set(goal.id for goal in goals)), 3)
+        self.assertEquals([(number, error.value) for number, error in errors],
+                          [(2, "Could not find the word 'every' in input"), (5, "Goal text is too long")])
+
+        for goal in goals:
+            self.assertEquals(goal.scheduledinstance_set.count(), 5)
+
     def test_day_string(self):
 
         self.assertEquals(self.simple_goal.day_string(), "Every day")
@@ -348,6 +673,94 @@ class ScheduledInstanceTest(TestCase):
 
         self.assertRaises(IntegrityError, dup.save)
 
+    def test_insert_missing(self):
+        instances = self.simple_goal.scheduled_instances(self.today, 3)
+
+        self.assertEquals(ScheduledInstance.insert_missing(instances), (2, 1))
+        self.assertEquals(self.simple_goal.scheduledinstance_set.count(), 3)
+
+        self.assertEquals(self.simple_goal.create_scheduled_instances(self.today, 4), (1, 3))
+        self.assertEquals(ScheduledInstance.insert_missing([]), (0, 0))
+
+    def test_complete_many(self):
+        incremental_goal = Goal()
+        incremental_goal.user = self.user
+        incremental_goal.parse("Go to the gym 2 times every week")
+        incremental_goal.save()
+        incremental_goal.create_scheduled_instances(self.today, 1)
+
+        incremental = incremental_goal.scheduledinstance_set.get()
+
+        other_user = User(username="bar", password="blah1234")
+        other_user.save()
+
+        # someone else's instance is left alone
+        self.assertEquals(ScheduledInstance.complete_many([self.i1.id], other_user), [])
+        self.assertFalse(ScheduledInstance.objects.get(pk=self.i1.pk).completed)
+
+        # and someone else's virtual instance isn't written at all
+        tomorrow = VirtualInstance(self.simple_goal, *next(self.simple_goal.occurrences(self.today + datetime.timedelta(days=1))))
+        self.assertEquals(ScheduledInstance.complete_many([tomorrow.id], other_user), [])
+        self.assertEquals(self.simple_goal.scheduledinstance_set.count(), 1)
+
+        ids = [self.i1.id, incremental.id]
+
+        self.assertEquals(set(ScheduledInstance.complete_many(ids, self.user)),
+                          set([self.simple_goal.id, incremental_goal.id]))
+
+        self.assertTrue(ScheduledInstance.objects.get(pk=self.i1.pk).completed)
+
+        incremental = ScheduledInstance.objects.get(pk=incremental.pk)
+        self.assertEquals((incremental.current_progress, incremental.completed), (1, False))
+
+        ScheduledInstance.complete_many([incremental.id], self.user)
+
+        incremental = ScheduledInstance.objects.get(pk=incremental.pk)
+        self.assertEquals((incremental.current_progress, incremental.completed), (2, True))
+
+    def test_mark_complete(self):
+        incremental_goal = Goal()
+        incremental_goal.user = self.user
+        incremental_goal.parse("Go to the gym 3 times every day")
+        incremental_goal.save()
+        incremental_goal.create_scheduled_instances(self.today - datetime.timedelta(days=30), 30)
+        self.simple_goal.create_scheduled_instances(self.today - datetime.timedelta(days=30), 30)
+
+        ids = list(ScheduledInstance.objects.values_list('id', flat=True))
+
+        with self.assertNumQueries(3):
+            goal_ids = ScheduledInstance.mark_complete(ids, self.user)
+
+        self.assertEquals(set(goal_ids), set([self.simple_goal.id, incremental_goal.id]))
+        self.assertFalse(ScheduledInstance.objects.filter(completed=False).exists())
+        self.assertEquals(set(incremental_goal.scheduledinstance_set.values_list('current_progress', flat=True)), set([3]))
+        self.assertEquals(set(self.simple_goal.scheduledinstance_set.values_list('current_progress', flat=True)), set([0]))
+
+    def test_repair_due_dates(self):
+        weekly_goal = Goal()
+        weekly_goal.user = self.user
+        weekly_goal.parse("Do a timed mile run every week")
+        weekly_goal.save()
+
+        for goal in [self.simple_goal, weekly_goal]:
+            goal.create_scheduled_instances(self.today, 4)
+
+        expected = dict((instance.id, instance.due_date) for instance in ScheduledInstance.objects.exclude(pk=self.i1.pk))
+
+        ScheduledInstance.objects.update(due_date=None)
+
+        instances = list(weekly_goal.scheduledinstance_set.order_by('-date'))
+        self.assertEquals(ScheduledInstance.compute_due_dates(weekly_goal, instances),
+                          [expected[instance.id] for instance in instances])
+
+        # the last weekly instance needs an occurrence that has no row yet
+        self.assertEquals(ScheduledInstance.repair_due_dates(), 8)
+
+        for instance_id, due_date in expected.items():
+            self.assertEquals(ScheduledInstance.objects.get(pk=instance_id).due_date, due_date)
+
+        self.assertEquals(ScheduledInstance.objects.get(pk=self.i1.pk).due_date, self.today + datetime.timedelta(days=1))
+
     def test_due_date(self):
         self.assertEquals(self.i1.compute_due_date(), self.today + datetime.timedelta(days=1))
 
@@ -382,3 +795,489 @@ class ScheduledInstanceTest(TestCase):
         bymonth_instance = bymonth_goal.scheduledinstance_set.all()[0]
         self.assertEquals(bymonth_instance.compute_due_date(), bymonth_instance.date + datetime.timedelta(days=1))
 
+    def test_due_dates_of_a_goal_come_from_one_expansion(self):
+        goal = Goal()
+        goal.user = self.user
+        goal.parse("Pet a kitty every other day")
+        goal.save()
+        goal.create_scheduled_instances(self.today, 5)
+        goal.scheduledinstance_set.update(due_date=None)
+
+        due_date_cache.clear()
+        expansions = []
+        occurrences = Goal.__dict__['occurrences']
+
+        def counting_occurrences(goal, start):
+            expansions.append(start)
+            return occurrences(goal, start)
+
+        Goal.occurrences = counting_occurrences
+
+        try:
+            instances = list(goal.scheduledinstance_set.order_by('date'))
+            due_dates = [instance.compute_due_date() for instance in instances]
+        finally:
+            Goal.occurrences = occurrences
+
+        self.assertEquals(len(expansions), 1)
+        self.assertEquals(due_dates, [instance.date + datetime.timedelta(days=2) for instance in instances])
+
+
+class UserProfileTest(TestCase):
+    def test_timezone_table_is_reused_until_next_transition(self):
+        UserProfile._timezone_table = None
+
+        choices = UserProfile.pretty_timezone_choices()
+
+        self.assertTrue(UserProfile.pretty_timezone_choices() is choices)
+        self.assertTrue(('America/Los_Angeles', UserProfile.pretty_timezone_dict()['America/Los_Angeles']) in choices)
+
+        now = datetime.datetime.utcnow()
+        self.assertTrue(UserProfile._timezone_table[2] > now)
+
+        valid_until = UserProfile.next_transition(pytz.timezone('America/Los_Angeles'), now)
+        self.assertTrue(UserProfile._timezone_table[2] <= valid_until)
+
+        UserProfile._timezone_table = (choices, {}, now)
+
+        self.assertFalse(UserProfile.pretty_timezone_choices() is choices)
+
+class ProfilingTest(TestCase):
+    def test_query_recorder(self):
+        from habits.profiling import QueryRecorder
+
+        user = User(username="foo", password="blah1234")
+        user.save()
+
+        with QueryRecorder() as recorder:
+            list(Goal.objects.filter(user=user))
+            list(User.objects.filter(username="foo"))
+
+        self.assertEquals(recorder.count, 2)
+        self.assertEquals([query['params'] for query in recorder.queries], [(user.id,), ("foo",)])
+        self.assertTrue(recorder.slowest() in recorder.queries)
+        self.assertFalse('make_debug_cursor' in connection.__dict__)
+
+        # nothing is recorded once the block is left
+        list(Goal.objects.all())
+        self.assertEquals(recorder.count, 2)
+
+class BenchmarkTest(TestCase):
+    def test_suite(self):
+        from habits.benchmarks import data, suite
+
+        counts = data.populate(users=2, goals_per_user=2, days=20)
+        self.assertEquals(counts['goals'], Goal.objects.count())
+        self.assertEquals(counts['instances'], ScheduledInstance.objects.count())
+
+        users = list(User.objects.filter(username__startswith="load0_"))
+        results = suite.Suite(users, 3).run(1)
+
+        self.assertEquals(sorted(results.keys()),
+                          sorted(['standard_data', 'streaks', 'past_instances_by_day', 'current_streak',
+                                  'Goal.parse', 'Goal.parse (cached)', 'geninstances']))
+        self.assertEquals(results['streaks']['runs'], 3)
+        self.assertEquals(results['geninstances']['runs'], 1)
+        self.assertTrue(results['standard_data']['median_ms'] <= results['standard_data']['p95_ms'])
+
+    def test_genload(self):
+        def generated(prefix):
+            goals = Goal.objects.filter(user__username__startswith=prefix).order_by('id')
+            instances = ScheduledInstance.objects.filter(goal__in=goals).order_by('id')
+
+            return ([(g.user.userprofile.timezone, g.rrule, g.incremental, g.streak, g.longest_streak) for g in goals],
+                    [(i.date, i.completed, i.skipped, i.current_progress) for i in instances])
+
+        anchor = timezone.now().strftime("%Y-%m-%dT%H:%M:%S")
+
+        call_command('genload', users=3, goals=4, days=60, seed=7, timezones=5, incremental_ratio=0.5,
+                     prefix="a", anchor=anchor)
+        call_command('genload', users=3, goals=4, days=60, seed=7, timezones=5, incremental_ratio=0.5,
+                     prefix="b", anchor=anchor)
+
+        goals, instances = generated("a")
+
+        self.assertEquals(len(goals), 12)
+        self.assertEquals((goals, instances), generated("b"))
+
+        for goal in Goal.objects.filter(user__username__startswith="a").select_related('user__userprofile'):
+            self.assertEquals((goal.streak, goal.longest_streak), goal.streaks_from_history())
+            self.assertEquals(goal.materialized_until, goal.scheduledinstance_set.latest('date').date)
+
+            instances = list(goal.scheduledinstance_set.filter(due_date__isnull=False))
+            self.assertEquals([instance.due_date for instance in instances],
+                              ScheduledInstance.compute_due_dates(goal, instances))
+
+        # an anchor in the past ends the history there
+        call_command('genload', users=1, goals=2, days=30, seed=7, prefix="c", anchor="2013-06-01")
+
+        latest = ScheduledInstance.objects.filter(goal__user__username__startswith="c").latest('date').date
+        self.assertTrue(latest <= datetime.datetime(2013, 6, 1, tzinfo=pytz.utc))
+        self.assertTrue(latest > datetime.datetime(2013, 5, 1, tzinfo=pytz.utc))
+
+class QueryPlanTest(TransactionTestCase):
+    # sqlite commits before EXPLAIN, which would end a TestCase's transaction
+    indexed = False
+
+    def setUp(self):
+        # the test database is built without migrations; add the indexes
+        # production gets from 0018
+        if not QueryPlanTest.indexed:
+            import importlib
+            migration = importlib.import_module('habits.migrations.0018_auto__add_index_scheduledinstance_composite')
+            migration.Migration().forwards(None)
+            QueryPlanTest.indexed = True
+
+    def test_check_plans(self):
+        from habits.benchmarks import data, plans
+
+        data.populate(users=2, goals_per_user=3, days=30)
+        user = User.objects.filter(username__startswith="load0_").order_by('id')[0]
+
+        results = plans.check_plans(user, repeat=1)
+
+        self.assertEquals(set(result['method'] for result in results),
+                          set(name for name, run in plans.page_queries(user)))
+        self.assertTrue(all(result['plan'] for result in results))
+        self.assertEquals([(result['method'], result['full_scans']) for result in results if result['full_scans']], [])
+
+    def test_recent_due_instances_plan_is_bounded(self):
+        from habits.benchmarks import data, plans
+        from habits.profiling import QueryRecorder
+
+        # two years of history
+        data.populate(users=1, goals_per_user=3, days=730)
+        user = User.objects.get(username="load0_0")
+
+        usercontext.activate(user.id, user.userprofile.timezone)
+
+        try:
+            with QueryRecorder() as recorder:
+                instances = list(Goal.recent_due_instances(user))
+        finally:
+            usercontext.deactivate()
+
+        self.assertEquals(recorder.count, 1)
+        self.assertEquals(len(instances), 3 * Goal.MISSED_INSTANCES)
+
+        query = recorder.queries[0]
+        plan = plans.explain(query['sql'], query['params'])
+
+        self.assertEquals(plans.full_scans(plan), [])
+
+        if connection.vendor == 'sqlite':
+            # only the goal's latest due instances are searched, not its history
+            self.assertTrue(any(step.startswith('SEARCH habits_scheduledinstance ') and 'due_date>?' in step
+                                for step in plan), plan)
+
+# requests aren't sampled into the querystats log unless a test asks
+@override_settings(HABITS_QUERY_STATS_SAMPLE_RATE=0)
+class ViewTest(TestCase):
+    def setUp(self):
+        self.user = User(username="foo")
+        self.user.set_password("blah1234")
+        self.user.save()
+
+        self.client.login(username="foo", password="blah1234")
+
+    def add_goals(self, count):
+        for i in xrange(count):
+            goal = Goal()
+            goal.user = self.user
+            goal.parse("Thing %d every day starting jan 1 2013" % i)
+            goal.save()
+            goal.create_scheduled_instances(Goal.beginning_today(self.user) - datetime.timedelta(days=10), 12)
+
+    def count_queries(self, url):
+        from django.db import connection
+
+        # the query log is reset when each request starts
+        connection.use_debug_cursor = True
+
+        try:
+            response = self.client.get(url)
+            self.assertEquals(response.status_code, 200)
+
+            return len(connection.queries)
+        finally:
+            connection.use_debug_cursor = None
+
+    @override_settings(HABITS_QUERY_STATS_HEADERS=True, HABITS_QUERY_STATS_SAMPLE_RATE=0)
+    def test_query_stats_headers(self):
+        self.add_goals(2)
+        queries = self.count_queries('/habits/streaks/')
+
+        response = self.client.get('/habits/streaks/')
+
+        self.assertEquals(int(response['X-Query-Count']), queries)
+        self.assertTrue(response['X-Query-Time'].endswith('ms'))
+        self.assertTrue(response['X-Response-Time'].endswith('ms'))
+        self.assertTrue('SELECT' in response['X-Slowest-Query'])
+
+    @override_settings(HABITS_QUERY_STATS_HEADERS=True)
+    def test_query_stats_header_with_non_ascii_sql(self):
+        from django.http import HttpResponse
+        from habits.middleware import QueryStatsMiddleware
+
+        middleware = QueryStatsMiddleware()
+        request = RequestFactory().get('/habits/')
+
+        middleware.process_request(request)
+        request._query_recorder.record("SELECT  'caf\xc3\xa9'", (), 0.5)
+
+        response = middleware.process_response(request, HttpResponse())
+
+        self.assertEquals(response['X-Slowest-Query'], "500.00ms SELECT 'caf?'")
+
+    @override_settings(HABITS_QUERY_STATS_HEADERS=False, HABITS_QUERY_STATS_SAMPLE_RATE=1)
+    def test_query_stats_are_logged_when_sampled(self):
+        import logging
+
+        logged = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                logged.append(json.loads(record.getMessage()))
+
+        # captured instead of going to the console handler
+        logger = logging.getLogger('habits.querystats')
+        handlers, logger.handlers = logger.handlers, [Handler()]
+
+        try:
+            response = self.client.get('/habits/streaks/')
+        finally:
+            logger.handlers = handlers
+
+        self.assertFalse(response.has_header('X-Query-Count'))
+        self.assertEquals(len(logged), 1)
+        self.assertEquals(logged[0]['view'], 'habits.views.streaks')
+        self.assertEquals(logged[0]['status'], 200)
+        self.assertTrue(logged[0]['queries'] > 0)
+
+    @override_settings(HABITS_DASHBOARD_CACHE_TIMEOUT=60)
+    def test_dashboard_cache(self):
+        from django.core.cache import cache
+
+        cache.clear()
+        self.add_goals(2)
+
+        self.count_queries('/habits/')
+
+        # only the session and the user are loaded on a hit
+        self.assertEquals(self.count_queries('/habits/'), 2)
+
+        todo = self.client.get('/habits/').context['todo']
+        self.assertEquals(len(todo), 2)
+
+        self.client.post('/habits/completed/', {'instance[]': [todo[0].id]})
+
+        response = self.client.get('/habits/')
+        self.assertEquals(response.context['completed'], [todo[0]])
+        self.assertEquals(response.context['todo'], [todo[1]])
+
+        self.client.get('/habits/skip/%d/' % todo[1].id)
+        self.assertEquals(self.client.get('/habits/').context['skipped'], [todo[1]])
+
+        Goal.objects.get(pk=todo[0].goal_id).delete()
+        self.assertEquals(len(self.client.get('/habits/').context['goals']), 1)
+
+    def test_today_json_without_shared_cache(self):
+        self.add_goals(1)
+
+        response = self.client.get('/habits/today/')
+
+        self.assertEquals(len(json.loads(response.content)['todo']), 1)
+        self.assertFalse(response.has_header('ETag'))
+
+    @override_settings(HABITS_DASHBOARD_CACHE_TIMEOUT=60)
+    def test_today_json(self):
+        self.add_goals(2)
+
+        response = self.client.get('/habits/today/')
+        etag = response['ETag']
+        todo = json.loads(response.content)['todo']
+
+        self.assertEquals(len(todo), 2)
+        self.assertEquals(set(todo[0].keys()),
+                          set(['id', 'goal_id', 'description', 'date', 'due_date', 'incremental',
+                               'current_progress', 'goal_amount', 'streak']))
+        self.assertFalse(etag.startswith('W/'))
+
+        from django.db import connection
+
+        connection.use_debug_cursor = True
+
+        try:
+            response = self.client.get('/habits/today/', HTTP_IF_NONE_MATCH=etag)
+
+            self.assertEquals(response.status_code, 304)
+            self.assertEquals(response.content, '')
+            # the session and the user
+            self.assertEquals(len(connection.queries), 2)
+        finally:
+            connection.use_debug_cursor = None
+
+        self.client.post('/habits/completed/', {'instance[]': [todo[0]['id']]})
+
+        response = self.client.get('/habits/today/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(response['ETag'], etag)
+        self.assertEquals([i['id'] for i in json.loads(response.content)['completed']], [todo[0]['id']])
+
+    def test_data_version(self):
+        from habits import cache
+
+        self.add_goals(1)
+        goal = Goal.objects.get(user=self.user)
+        instance = goal.scheduledinstance_set.all()[0]
+
+        versions = [cache.data_version(self.user.id)]
+
+        def changed():
+            versions.append(cache.data_version(self.user.id))
+            return versions[-1] != versions[-2]
+
+        self.assertFalse(changed())
+
+        goal.description = "Other thing"
+        goal.save()
+        self.assertTrue(changed())
+
+        profile = self.user.userprofile
+        profile.timezone = "Europe/Paris"
+        profile.save()
+        self.assertTrue(changed())
+
+        self.client.post('/habits/edit_streaks/', {'skip[]': [instance.id]})
+        self.assertTrue(changed())
+
+        ScheduledInstance.mark_complete([instance.id], self.user)
+        self.assertTrue(changed())
+
+        instance = ScheduledInstance.objects.get(pk=instance.pk)
+        instance.progress()
+        instance.save()
+        self.assertTrue(changed())
+
+        instance.delete()
+        self.assertTrue(changed())
+
+        goal.delete()
+        self.assertTrue(changed())
+        self.assertEquals(deleting_goal_ids(), set())
+
+    def test_data_version_is_bumped_after_the_view(self):
+        from django.http import HttpResponse
+        from habits import cache
+
+        inside = []
+
+        @cache.bumps_data_version
+        def view(request):
+            inside.append(cache.data_version(request.user.id))
+            return HttpResponse()
+
+        request = RequestFactory().get('/habits/')
+        request.user = self.user
+        view(request)
+
+        self.assertNotEquals(cache.data_version(self.user.id), inside[0])
+
+    def test_deleting_a_goal_does_not_query_per_instance(self):
+        from habits.profiling import QueryRecorder
+
+        def delete_queries(instances):
+            goal = Goal()
+            goal.user = self.user
+            goal.parse("Thing every day starting jan 1 2013")
+            goal.save()
+            goal.create_scheduled_instances(Goal.beginning_today(self.user) - datetime.timedelta(days=60), instances)
+
+            with QueryRecorder() as recorder:
+                goal.delete()
+
+            return recorder.count
+
+        self.assertEquals(delete_queries(2), delete_queries(50))
+
+    def test_timezone_is_only_cached_in_a_shared_cache(self):
+        from habits import cache
+
+        self.assertEquals(cache.user_timezone(User.objects.get(pk=self.user.pk)), "America/Los_Angeles")
+
+        # as if changed by another process
+        UserProfile.objects.filter(user=self.user).update(timezone="Europe/Paris")
+        self.assertEquals(cache.user_timezone(User.objects.get(pk=self.user.pk)), "Europe/Paris")
+
+        with override_settings(HABITS_DASHBOARD_CACHE_TIMEOUT=60):
+            self.assertEquals(cache.user_timezone(User.objects.get(pk=self.user.pk)), "Europe/Paris")
+
+            profile = UserProfile.objects.get(user=self.user)
+            profile.timezone = "Asia/Tokyo"
+            profile.save()
+
+            self.assertEquals(cache.user_timezone(User.objects.get(pk=self.user.pk)), "Asia/Tokyo")
+
+    def test_import_goals_endpoint(self):
+        response = self.client.post('/habits/import_goals/', {'goals': "Walk every day\n\nnope\nRun every week\n"})
+
+        self.assertEquals(json.loads(response.content),
+                          {'created': 2, 'errors': [{'line': 3, 'error': "Could not find the word 'every' in input"}]})
+        self.assertEquals(Goal.objects.filter(user=self.user).count(), 2)
+
+    def test_skip_instance(self):
+        self.add_goals(1)
+        instance = ScheduledInstance.objects.filter(goal__user=self.user)[0]
+
+        self.assertRaises(Resolver404, resolve, '/habits/skip/12-3/')
+
+        request = RequestFactory().get('/habits/skip/%d/' % instance.id)
+        request.user = User.objects.create(username="bar")
+
+        self.assertRaises(Http404, views.skip_instance, request, str(instance.id))
+        self.assertFalse(ScheduledInstance.objects.get(pk=instance.pk).skipped)
+
+        self.assertEquals(self.client.get('/habits/skip/%d/' % instance.id).status_code, 302)
+        self.assertTrue(ScheduledInstance.objects.get(pk=instance.pk).skipped)
+
+    def test_streaks_page_queries_do_not_grow_with_goals(self):
+        self.add_goals(2)
+        few = self.count_queries('/habits/streaks/')
+
+        self.add_goals(6)
+        many = self.count_queries('/habits/streaks/')
+
+        self.assertEquals(few, many)
+
+class CompletionConcurrencyTest(TransactionTestCase):
+    @skipIf(connection.vendor == 'sqlite' and connection.settings_dict.get('TEST_NAME') in (None, ':memory:'),
+            "needs a test database that allows concurrent connections")
+    def test_parallel_completions_do_not_lose_updates(self):
+        user = User(username="foo", password="blah1234")
+        user.save()
+
+        goal = Goal()
+        goal.user = user
+        goal.parse("Do pushups 20 times every day")
+        goal.save()
+        goal.create_scheduled_instances(Goal.beginning_today(user), 1)
+
+        instance = goal.scheduledinstance_set.get()
+
+        def complete():
+            try:
+                ScheduledInstance.complete_many([instance.id], user)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=complete) for i in xrange(10)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        instance = ScheduledInstance.objects.get(pk=instance.pk)
+        self.assertEquals(instance.current_progress, 10)
+        self.assertFalse(instance.completed)
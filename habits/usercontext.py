@@ -0,0 +1,42 @@
+"""
+Timezone information for the user a request is being served for, resolved
+once per request by habits.middleware.UserTimezoneMiddleware so that model
+code doesn't have to go through user.userprofile every time it needs it.
+"""
+
+import threading
+
+import pytz
+from django.utils import timezone
+
+_local = threading.local()
+
+def local_midnight_utc(tz, now=None):
+    now_local = (now or timezone.now()).astimezone(tz)
+    local_midnight = now_local.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    return local_midnight.astimezone(pytz.utc)
+
+class UserContext(object):
+    def __init__(self, user_id, tz_name):
+        self.user_id = user_id
+        self.tz_name = tz_name
+        self.tz = pytz.timezone(tz_name)
+        self.beginning_today = local_midnight_utc(self.tz)
+
+def activate(user_id, tz_name):
+    _local.context = UserContext(user_id, tz_name)
+
+def deactivate():
+    _local.context = None
+
+def current(user_id):
+    """
+    The active context if it belongs to user_id, otherwise None.
+    """
+    context = getattr(_local, 'context', None)
+
+    if context is not None and context.user_id == user_id:
+        return context
+
+    return None
@@ -3,32 +3,42 @@ from django.contrib.auth import logout as auth_logout
 from django.contrib.auth.decorators import login_required
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.contrib import messages
 from django.db.models import F
+from django.db import transaction
+from django.views.decorators.http import condition
 
 from django.utils import timezone
 import pytz
 
 from habits.models import Goal, ScheduledInstance, UserProfile
+from habits import cache
 import datetime
+import json
 import sys
 
 
 def standard_data(request, error_message=None):
-    todo = Goal.goals_for_today(request.user)
-    completed = Goal.completed_goals_for_today(request.user)
+    today = Goal.cached_instances_for_today(request.user)
     tomorrow = Goal.beginning_today(request.user) + datetime.timedelta(days=1)
+    tz_name = Goal.user_tz(request.user).zone
 
-    return {'skipped': Goal.skipped_goals_for_today(request.user),
-            'goals': Goal.objects.filter(user=request.user).select_related('scheduledinstances'),
-            'todo': todo,
-             'completed': completed,
+    return {'skipped': today['skipped'],
+            'goals': today['goals'],
+            'todo': today['todo'],
+             'completed': today['completed'],
              'tomorrow': tomorrow,
-             'user_tz': request.user.userprofile.timezone,
-              'readable_tz': request.user.userprofile.readable(),
+             'user_tz': tz_name,
+              'readable_tz': UserProfile.pretty_timezone_dict()[tz_name],
              'error_message': error_message}
 
+def get_instance_or_404(instance_id, user):
+    try:
+        return ScheduledInstance.resolve(instance_id, user)
+    except ScheduledInstance.DoesNotExist:
+        raise Http404
+
 def home(request):
     """Home view, displays login mechanism"""
     if request.user.is_authenticated():
@@ -65,60 +75,106 @@ def main(request):
     return render_to_response("main.html", standard_data(request),
                                 context_instance=RequestContext(request))
 
+def today_etag(request):
+    """
+    Changes whenever the user's goals or instances change or their day ends,
+    and only then. Data versions are only consistent between processes in a
+    shared cache, so no ETag is sent without one.
+    """
+    if not cache.shared_cache_enabled():
+        return None
+
+    return "today-%d-%d-%s" % (request.user.id, cache.data_version(request.user.id),
+                               Goal.beginning_today(request.user).strftime("%Y%m%d%H%M"))
+
+def instance_data(instance):
+    return {'id': instance.id,
+            'goal_id': instance.goal_id,
+            'description': instance.goal.description,
+            'date': instance.date.isoformat(),
+            'due_date': instance.due_date.isoformat() if instance.due_date else None,
+            'incremental': instance.goal.incremental,
+            'current_progress': instance.current_progress,
+            'goal_amount': instance.goal.goal_amount,
+            'streak': instance.goal.streak}
+
+@login_required
+@condition(etag_func=today_etag)
+def today(request):
+    """
+    The dashboard as JSON for clients that poll it. Sends an ETag, when the
+    cache is shared, so unchanged polls are answered with an empty 304.
+    """
+    data = Goal.cached_instances_for_today(request.user)
+
+    return HttpResponse(json.dumps({'todo': [instance_data(i) for i in data['todo']],
+                                    'completed': [instance_data(i) for i in data['completed']],
+                                    'skipped': [instance_data(i) for i in data['skipped']]}),
+                        content_type='application/json')
+
 @login_required
+@cache.bumps_data_version
+@transaction.commit_on_success
 def completed(request):
     try:
         instance_ids = request.POST.getlist('instance[]')
 
-        for instance_id in instance_ids:
-            instance = get_object_or_404(ScheduledInstance, pk = instance_id)
+        goal_ids = ScheduledInstance.complete_many(instance_ids, request.user)
 
-            instance.progress()
-
-            instance.save()
+        Goal.refresh_streaks(goal_ids)
 
         return HttpResponseRedirect(reverse("habits.views.main"))
 
     except Exception:
+        # commit_on_success would commit whatever was written before the error
+        transaction.rollback()
         messages.error(request, "Please choose a goal to complete.")
 
         return HttpResponseRedirect(reverse("habits.views.main"))
 
 @login_required
 def streaks(request):
-    return render_to_response("streaks.html", {'goals': Goal.objects.filter(user=request.user).select_related('scheduledinstances'),
-                                                'byday': Goal.past_instances_by_day(request.user),
+    goals, instances = Goal.with_missed_instances(request.user)
+
+    return render_to_response("streaks.html", {'goals': goals,
+                                                'byday': Goal.past_instances_by_day(request.user, instances),
                                                 'user_tz': request.user.userprofile.timezone,
                                                 'readable_tz': request.user.userprofile.readable()},
         context_instance=RequestContext(request))
 
 @login_required
+@cache.bumps_data_version
+@transaction.commit_on_success
 def edit_streaks(request):
     try:
         instance_ids = request.POST.getlist('complete[]')
 
-        instances = ScheduledInstance.objects.filter(id__in=instance_ids)
-
-        for instance in instances:
-            instance.completed = True
-
-            if instance.goal.incremental:
-                instance.current_progress = instance.goal.goal_amount
-
-            instance.save()
+        goal_ids = ScheduledInstance.mark_complete(instance_ids, request.user)
 
         instance_ids = request.POST.getlist('skip[]')
 
-        instances = ScheduledInstance.objects.filter(id__in=instance_ids).update(skipped=True)
+        instances = ScheduledInstance.objects.filter(id__in=instance_ids, goal__user=request.user)
+        goal_ids.extend(instances.values_list('goal', flat=True))
+        instances.update(skipped=True)
+
+        Goal.refresh_streaks(goal_ids)
 
         return HttpResponseRedirect(reverse("habits.views.streaks"))
 
     except Exception:
+        transaction.rollback()
+
         return HttpResponseRedirect(reverse("habits.views.streaks"))
 
 @login_required
+@cache.bumps_data_version
+@transaction.commit_on_success
 def skip_instance(request, instance_id):
-    ScheduledInstance.objects.filter(id=instance_id).update(skipped=True)
+    instance = get_instance_or_404(instance_id, request.user)
+
+    ScheduledInstance.objects.filter(id=instance.id).update(skipped=True)
+
+    Goal.refresh_streaks([instance.goal_id])
 
     return HttpResponseRedirect(reverse("habits.views.main"))
 
@@ -142,6 +198,7 @@ def edit_description(request, goal_id):
     return HttpResponseRedirect(reverse("habits.views.main"))
 
 @login_required
+@cache.bumps_data_version
 def delete_goal(request, goal_id):
     goal = get_object_or_404(Goal, pk = goal_id)
     goal.delete()
@@ -177,6 +234,24 @@ def new_goal(request):
         return render_to_response("main.html", standard_data(request, error_message),
             context_instance=RequestContext(request))
 
+@login_required
+@cache.bumps_data_version
+@transaction.commit_on_success
+def import_goals(request):
+    """
+    Creates many goals at once from the newline-delimited goal texts in the
+    'goals' POST field. Responds with the number created and the lines that
+    could not be parsed.
+    """
+    lines = [(number, text) for number, text in enumerate(request.POST.get('goals', '').splitlines(), 1)
+             if text.strip()]
+
+    goals, errors = Goal.import_goals(request.user, lines)
+
+    return HttpResponse(json.dumps({'created': len(goals),
+                                    'errors': [{'line': number, 'error': error.value} for number, error in errors]}),
+                        content_type='application/json')
+
 @login_required
 def edit_tz(request):
     tz_names = UserProfile.pretty_timezone_choices
@@ -185,21 +260,17 @@ def edit_tz(request):
                                             'timezones': tz_names}, context_instance=RequestContext(request))
 
 @login_required
+@cache.bumps_data_version
+@transaction.commit_on_success
 def update_tz(request):
-    old_today = Goal.beginning_today(request.user)
-
     new_timezone = request.POST['timezone']
 
     profile = request.user.userprofile
+    old_timezone = profile.timezone
     profile.timezone = new_timezone
     profile.save()
 
-    for goal in request.user.goal_set.all():
-        goal.scheduledinstance_set.filter(date__gt=timezone.now()).delete()
-
-        goal.scheduledinstance_set.filter(date=old_today).delete()
-        new_today = Goal.beginning_today(request.user)
-        goal.create_scheduled_instances(new_today, 5)
+    Goal.rebase_timezone(request.user, old_timezone, new_timezone)
 
     return HttpResponseRedirect(reverse("habits.views.main"))
  